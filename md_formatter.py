@@ -1,67 +1,151 @@
-from collections.abc import Callable
+from collections.abc import Callable, Iterable, Iterator
+import argparse
+import bisect
+import cProfile
+import difflib
+import fnmatch
+import functools
+import hashlib
+import itertools
+import json
+import multiprocessing
 import os
+import queue
+import re
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
 
 numbers = list("0123456789")
 letters = list("abcdefghijklmnopqrstuvwxyz")
 newlines = ["\n", "\r", "\r\n", "\n\r"]
 illegal_chars = '<>:"/\|?*' + '[]'
+gdoc_tag_pattern = re.compile(r"\[[a-z]{1,2}\]")
+# [[target]] or [[target|alias]]
+link_pattern = re.compile(r"\[\[([^\[\]|\n]+)(?:\|([^\[\]\n]*))?\]\]")
 
 # tools
 
+class LineKind:
+    # bit flags, since a line can be of several kinds.
+    # plain ints rather than enum.IntFlag, whose operators are too slow for every line.
+    NL = 1 << 0
+    H = 1 << 1
+    UL_LI = 1 << 2
+    UL_CB = 1 << 3
+    OL_LI = 1 << 4
+    DV_INLINE_FIELD = 1 << 5
+    BLOCKQUOTE = 1 << 6
+    CODEBLOCK_FENCE = 1 << 7
+    TR = 1 << 8
+    FOOTNOTE = 1 << 9
+    FORCING_NL = 1 << 10
+    P = 1 << 11
+
+    LI = UL_LI | OL_LI | DV_INLINE_FIELD
+    NOT_P = NL | H | LI | BLOCKQUOTE | CODEBLOCK_FENCE | TR | FOOTNOTE
+
+h_pattern = re.compile(r"#{1,6} ")
+ol_li_pattern = re.compile(r"[0-9]+[.)](?: |\Z)")
+
+def classify_line(line: str) -> int:
+    # long lines are rarely repeated and would only fill the cache
+    if len(line) > CLASSIFY_CACHE_MAX_LEN:
+        return classify_line_uncached(line)
+
+    return classify_line_cached(line)
+
+def classify_line_uncached(line: str) -> int:
+    if line == "\n":
+        return LineKind.NL
+
+    if not line:
+        return 0
+
+    stripped = line.strip()
+
+    if not stripped:
+        if is_nl(line):
+            return LineKind.NL
+        return 0 if line[0] == " " else LineKind.P
+
+    kind = 0
+
+    # headings and table rows are not stripped
+    first = line[0]
+    if first == "#" and h_pattern.match(line):
+        kind |= LineKind.H
+    elif first == "|":
+        kind |= LineKind.TR
+
+    first = stripped[0]
+    if first in "-*+":
+        if len(stripped) == 1 or stripped[1] == " ":
+            kind |= LineKind.UL_LI
+
+            # - [ ]
+            if (len(stripped) >= 5 and stripped[2] == "[" and stripped[4] == "]"
+                and (len(stripped) == 5 or stripped[5] == " ")):
+                kind |= LineKind.UL_CB
+    elif first in "0123456789":
+        if ol_li_pattern.match(stripped):
+            kind |= LineKind.OL_LI
+    elif first == ">":
+        if len(stripped) == 1 or stripped[1] == " ":
+            kind |= LineKind.BLOCKQUOTE
+    elif first == "`":
+        if stripped.startswith("```"):
+            kind |= LineKind.CODEBLOCK_FENCE
+    elif first == "[":
+        if len(stripped) >= 5 and stripped[1] == "^" and "]:" in stripped:
+            kind |= LineKind.FOOTNOTE
+
+    if stripped.find("::") > 0:
+        kind |= LineKind.DV_INLINE_FIELD
+
+    if stripped[-1] == "\\":
+        kind |= LineKind.FORCING_NL
+
+    if line[0] != " " and not kind & LineKind.NOT_P:
+        kind |= LineKind.P
+
+    return kind
+
+# most lines in a vault are unique, but blanklines, list markers and the like are not
+classify_line_cached = functools.lru_cache(maxsize=1 << 14)(classify_line_uncached)
+
 def is_p(line: str):
-    return (
-        len(line) >= 1 and not line[0] == " " and not is_nl(line)
-        and not is_h(line)
-        and not is_li(line)
-        and not is_blockquote(line)
-        and not is_codeblock_fence(line)
-        and not is_tr(line)
-        and not is_footnote(line)
-        and not is_dv_inline_field(line))
+    return bool(classify_line(line) & LineKind.P)
 
 def is_ul_li(line: str):
-    line = line.strip()
-    return len(line) >= 1 and line[0] in ["-", "*", "+"] and (len(line) == 1 or line[1] == " ")
+    return bool(classify_line(line) & LineKind.UL_LI)
 
 def is_ul_cb(line: str):
     # - [ ]
-    line = line.strip()
-    return (len(line) >= 5
-        and line[0] in ["-", "*", "+"]
-        and line[1] == " "
-        and line[2] == "["
-        and line[4] == "]"
-        and (len(line) == 5 or line[5] == " "))
+    return bool(classify_line(line) & LineKind.UL_CB)
 
 def is_ol_li(line: str):
-    line = line.strip().replace(")", ".")
-
-    dotindex = line.find(".")
-
-    if dotindex not in [-1, 0]:
-        potential_number = line[:dotindex]
-        for c in potential_number:
-            if c not in numbers:
-                return False
-
-        return len(line) == dotindex + 1 or line[dotindex + 1] == " "
-
-    return False
+    return bool(classify_line(line) & LineKind.OL_LI)
 
 def is_li(line: str):
-    return is_ul_li(line) or is_ol_li(line) or is_dv_inline_field(line)
+    return bool(classify_line(line) & LineKind.LI)
 
 def is_blockquote(line: str):
-    line = line.strip()
-    return len(line) >= 1 and line[0] == ">" and (len(line) == 1 or line[1] == " ")
+    return bool(classify_line(line) & LineKind.BLOCKQUOTE)
 
 def is_codeblock_fence(line: str):
-    return len(line) >= 3 and line.strip()[:3] == "```"
+    return bool(classify_line(line) & LineKind.CODEBLOCK_FENCE)
 
 def is_nl(line: str):
     return len(line) == 1 and line[0] in newlines
 
 def is_h(line: str, min_level: int = 1, max_level: int = 6, ignore_level=None):
+    if min_level == 1 and max_level == 6 and ignore_level is None:
+        return bool(classify_line(line) & LineKind.H)
+
     for level in range(min_level, max_level + 1):
         if ignore_level == level:
             continue
@@ -71,18 +155,157 @@ def is_h(line: str, min_level: int = 1, max_level: int = 6, ignore_level=None):
     return False
 
 def is_tr(line: str):
-    return len(line) >= 1 and line[0] == "|"
+    return bool(classify_line(line) & LineKind.TR)
 
 def is_footnote(line: str):
-    line = line.strip()
-    return len(line) >= 5 and line[0:2] == "[^" and "]:" in line
+    return bool(classify_line(line) & LineKind.FOOTNOTE)
 
 def is_forcing_nl(line: str):
-    return len(line) >= 1 and line.strip()[-1] == "\\"
+    return bool(classify_line(line) & LineKind.FORCING_NL)
 
 def is_dv_inline_field(line: str):
-    line = line.strip()
-    return line.find("::") > 0
+    return bool(classify_line(line) & LineKind.DV_INLINE_FIELD)
+
+def is_indented(line: str):
+    # indented code, as far as format_blanklines is concerned
+    return len(line) > 4 and line[:4] == "    "
+
+class BlockKind:
+    FRONTMATTER = 0
+    CODE = 1
+    TABLE = 2
+    LIST = 3
+    PARAGRAPH = 4
+    BLANK = 5
+    OTHER = 6
+
+    # copied as is by format_blanklines
+    AS_IS = (FRONTMATTER, CODE, TABLE, LIST)
+
+class Document:
+    # a note parsed once into blocks, for the transforms that need to know
+    # where the frontmatter, code, tables, lists and paragraphs are.
+    # blocks are (BlockKind, start, end) for lines[start:end], as format_blanklines sees them:
+    # indented lines are code, a paragraph is the lines it would merge into one,
+    # and headings, blockquotes and the like are other.
+    # shared through parse_document, so it must not be changed.
+
+    def __init__(self, lines: list[str], kinds: list[int] = None):
+        # kinds are those of the lines, if already known
+        self.lines = lines
+        self.kinds = kinds if kinds is not None else [classify_line(line) for line in lines]
+        self.blocks = []
+
+        # index of the first line after the leading blanklines
+        self.text_start = 0
+
+        self.parse()
+
+    def parse(self):
+        lines = self.lines
+        kinds = self.kinds
+        blocks = self.blocks
+        n = len(lines)
+
+        i = 0
+        while i < n and lines[i] == "\n":
+            i += 1
+
+        if i:
+            blocks.append((BlockKind.BLANK, 0, i))
+        self.text_start = i
+
+        # frontmatter runs until the next ---, or the end if there is none
+        if i < n and lines[i].strip() == "---":
+            j = i + 1
+            while j < n and lines[j].strip() != "---":
+                j += 1
+            j = min(j + 1, n)
+
+            blocks.append((BlockKind.FRONTMATTER, i, j))
+            i = j
+
+        fence = LineKind.CODEBLOCK_FENCE
+        tr = LineKind.TR
+        p = LineKind.P
+        nl = LineKind.NL
+        li = LineKind.LI
+        not_li = LineKind.CODEBLOCK_FENCE | LineKind.TR
+
+        while i < n:
+            kind = kinds[i]
+            j = i + 1
+
+            # indented lines are code, unless they continue a paragraph.
+            # is_indented, inlined since most blocks start with a paragraph
+            if kind & p and (lines[i][:4] != "    " or len(lines[i]) <= 4):
+                # a line forcing a newline isn't merged with the next ones
+                if not kind & LineKind.FORCING_NL:
+                    while j < n and kinds[j] & p:
+                        j += 1
+                blocks.append((BlockKind.PARAGRAPH, i, j))
+
+            elif kind & fence:
+                while j < n and not kinds[j] & fence:
+                    j += 1
+                j = min(j + 1, n)
+                blocks.append((BlockKind.CODE, i, j))
+
+            elif kind & nl:
+                while j < n and kinds[j] & nl:
+                    j += 1
+                blocks.append((BlockKind.BLANK, i, j))
+
+            elif is_indented(lines[i]):
+                while j < n and is_indented(lines[j]) and not kinds[j] & fence:
+                    j += 1
+                blocks.append((BlockKind.CODE, i, j))
+
+            elif kind & tr:
+                while j < n and kinds[j] & tr:
+                    j += 1
+                blocks.append((BlockKind.TABLE, i, j))
+
+            elif kind & li:
+                while j < n and kinds[j] & li and not kinds[j] & not_li and not is_indented(lines[j]):
+                    j += 1
+                blocks.append((BlockKind.LIST, i, j))
+
+            else:
+                blocks.append((BlockKind.OTHER, i, j))
+
+            i = j
+
+    def map_text(self, do: Callable[[str], str]) -> list[str]:
+        # do on every line but the frontmatter and code
+        new_lines = []
+
+        for block_kind, start, end in self.blocks:
+            if block_kind == BlockKind.FRONTMATTER or block_kind == BlockKind.CODE:
+                new_lines += self.lines[start:end]
+            else:
+                new_lines += [do(line) for line in self.lines[start:end]]
+
+        return new_lines
+
+# documents by the digest of their content, least recently used first
+document_cache = {}
+
+def parse_document(lines: list[str]) -> Document:
+    # a note is parsed once, however many transforms run on its lines,
+    # and not again when it's read again unchanged
+    digest = content_digest(lines)
+
+    # the same text may be split into lines differently
+    document = document_cache.pop(digest, None)
+    if document is None or document.lines != lines:
+        document = Document(lines)
+
+        if len(document_cache) >= DOCUMENT_CACHE_SIZE:
+            del document_cache[next(iter(document_cache))]
+
+    document_cache[digest] = document
+    return document
 
 # update tools
 
@@ -90,17 +313,39 @@ def link(filename: str, alias: str = None) -> str:
     return f"[[{filename[:-3] + (f'|{alias}' if alias else '')}]]"
 
 def remove_links(line: str):
-    while "[[" in line:
-        # if linked with alias, only keep alias
-        end = line.find("]]")
-        if "|" in line[:end]:
-            start = line.find("[[")
-            middle = line.find("|")
-            line = line[:start + 2] + line[middle + 1:]
+    # if linked with alias, only keep alias
+    if "[[" not in line:
+        return line
+    return link_pattern.sub(link_text, line)
+
+def link_text(match: re.Match) -> str:
+    return match.group(2) if match.group(2) is not None else match.group(1)
+
+def link_key(target: str) -> str:
+    # the name of the note a link points to: folder/note#heading -> note
+    name = target.split("#", 1)[0]
+    name = name[name.rfind("/") + 1:]
+    return name[:-3] if name.endswith(".md") else name
+
+def find_links(lines: list[str]) -> list[list]:
+    # [target, alias, line index, column] of every link outside code
+    links = []
+    document = Document(lines)
+
+    for block_kind, start, end in document.blocks:
+        if block_kind == BlockKind.CODE:
+            continue
+
+        for i in range(start, end):
+            if "[[" in lines[i]:
+                for match in link_pattern.finditer(lines[i]):
+                    links.append([match.group(1), match.group(2), i, match.start()])
 
-        line = line.replace("[[", "", 1).replace("]]", "", 1)
+    return links
 
-    return line
+def remove_links_lines(lines: list[str]) -> list[str]:
+    # remove_links, except in the frontmatter and code
+    return parse_document(lines).map_text(remove_links)
 
 def h(level: int):
     if level not in range(1, 7):
@@ -113,86 +358,864 @@ def italic(s: str):
 
 # read/write tools
 
-def write_lines(lines: list, dir_: str):
-    with open(dir_, "w", encoding="utf-8") as file:
+def write_lines(lines: list, dir_: str) -> os.stat_result:
+    print(f"writing {dir_} ...")
+    return write_atomic("".join(lines), dir_)
+
+def write(text: str, dir_: str) -> os.stat_result:
+    print(f"writing {dir_} ...")
+    return write_atomic(text, dir_)
+
+def write_from(tmp_dir: str, dir_: str) -> os.stat_result:
+    print(f"writing {dir_} ...")
+    return replace_atomic(tmp_dir, dir_)
+
+def write_atomic(text: str, dir_: str, fsync: bool = False) -> os.stat_result:
+    # write to a temporary file next to dir_ and replace it,
+    # so that a crash never leaves a half written note.
+    # returns the stat of what was written, which dir_ may no longer have if it's edited right away.
+
+    # a symlinked note is written through the link, like open(dir_, "w") did
+    dir_ = os.path.realpath(dir_)
+    fd, tmp_dir = mkstemp_next_to(dir_)
+
+    try:
+        with open(fd, "w", encoding="utf-8") as file:
+            file.write(text)
+
+            # through the handle that wrote it; fsync needs write access on windows
+            if fsync:
+                file.flush()
+                os.fsync(file.fileno())
+    except BaseException:
+        remove_quietly(tmp_dir)
+        raise
+
+    return replace_atomic(tmp_dir, dir_, fsync, synced=True)
+
+def mkstemp_next_to(dir_: str) -> tuple[int, str]:
+    # hidden, so that it's skipped by walk. next to what a symlink points to,
+    # so that it can replace that
+    return tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(os.path.realpath(dir_)) or ".")
+
+def remove_quietly(dir_: str):
+    try:
+        os.remove(dir_)
+    except FileNotFoundError:
+        pass
+
+def replace_atomic(tmp_dir: str, dir_: str, fsync: bool = False, synced: bool = False) -> os.stat_result:
+    # replace dir_, or what it links to, with tmp_dir, a file written next to that.
+    # synced is whether tmp_dir is already fsynced. returns the stat of tmp_dir
+
+    dir_ = os.path.realpath(dir_)
+    folder_path = os.path.dirname(dir_) or "."
+
+    try:
+        if fsync and not synced:
+            fsync_file(tmp_dir)
+
+        stat = os.stat(tmp_dir)
+
+        # mkstemp only gives the owner access
+        try:
+            shutil.copymode(dir_, tmp_dir)
+        except FileNotFoundError:
+            os.chmod(tmp_dir, 0o644)
+
+        os.replace(tmp_dir, dir_)
+
+    except BaseException:
+        remove_quietly(tmp_dir)
+        raise
+
+    if fsync:
+        fsync_folder(folder_path)
+
+    return stat
+
+def fsync_file(dir_: str):
+    # opened for writing, as fsync needs on windows
+    fd = os.open(dir_, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def fsync_folder(folder_path: str):
+    # makes the replace durable. folders can't be opened on windows
+    if os.name != "posix":
+        return
+
+    fd = os.open(folder_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class Writer:
+    # writes files atomically, optionally on a background thread so that
+    # reading and formatting the next files overlaps with the disk.
+    # fsync is "none", "file" (before every replace) or "run" (all files when closed).
+
+    def __init__(self, fsync: str = "none", background: bool = False, profile: "Profile" = None):
+        if fsync not in ["none", "file", "run"]:
+            raise ValueError(f"unknown fsync policy {fsync}")
+
+        self.fsync = fsync
+        self.background = background
+        self.profile = profile
+        self.written = []
+        self.bytes_written = 0
+        self.io_seconds = 0.0
+
+        self.error = None
+        self.queue = None
+        self.thread = None
+
+    def write_lines(self, lines: list[str], dir_: str):
         print(f"writing {dir_} ...")
-        file.writelines(lines)
+        self.submit(self.write, "".join(lines), dir_)
 
-def write(text: str, dir_: str):
-    with open(dir_, "w", encoding="utf-8") as file:
+    def write_from(self, tmp_dir: str, dir_: str):
         print(f"writing {dir_} ...")
-        file.write(text)
+        self.submit(self.replace, tmp_dir, dir_)
+
+    def submit(self, do: Callable[[str, str], None], text_or_tmp_dir: str, dir_: str):
+        if not self.background:
+            do(text_or_tmp_dir, dir_)
+            return
+
+        if self.error is not None:
+            raise self.error
+
+        # started on the first write rather than in __init__, so that it is never running
+        # when on_all forks its workers
+        if self.thread is None:
+            # bounded, so that a slow disk doesn't fill the memory with formatted files
+            self.queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+        self.queue.put((do, text_or_tmp_dir, dir_))
+
+    def write(self, text: str, dir_: str):
+        start = time.perf_counter()
+        stat = write_atomic(text, dir_, self.fsync == "file")
+        self.wrote(dir_, stat, start)
+
+    def replace(self, tmp_dir: str, dir_: str):
+        start = time.perf_counter()
+        stat = replace_atomic(tmp_dir, dir_, self.fsync == "file")
+        self.wrote(dir_, stat, start)
+
+    def wrote(self, dir_: str, stat: os.stat_result, start: float):
+        seconds = time.perf_counter() - start
+        self.io_seconds += seconds
+        self.bytes_written += stat.st_size
+        self.written.append((dir_, stat))
+
+        if self.profile is not None:
+            self.profile.spans.append(("write", dir_, os.getpid(), threading.get_native_id(),
+                start, seconds, stat.st_size, 0))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            do, text_or_tmp_dir, dir_ = item
+
+            # keep draining after an error, so that write_lines never blocks,
+            # but don't leave streamed files behind
+            if self.error is not None:
+                if do == self.replace:
+                    remove_quietly(text_or_tmp_dir)
+                continue
+
+            try:
+                do(text_or_tmp_dir, dir_)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+            if self.error is not None:
+                raise self.error
+
+        if self.fsync == "run":
+            start = time.perf_counter()
+
+            real_dirs = [os.path.realpath(dir_) for dir_, _ in self.written]
+
+            for dir_ in real_dirs:
+                fsync_file(dir_)
+
+            for folder_path in {os.path.dirname(dir_) or "." for dir_ in real_dirs}:
+                fsync_folder(folder_path)
+
+            self.io_seconds += time.perf_counter() - start
+
+    def __str__(self):
+        return f"wrote {len(self.written)} files ({self.bytes_written} bytes) in {self.io_seconds:.3f} s"
 
 def remove_illegal_chars(s: str):
     for c in illegal_chars:
         s = s.replace(c, "")
     return s
 
-def on_all(folder_path: str, ignore_folders: list[str], do: list[Callable[[list[str]], list[str]]]):
-    print(f"---\nreading {folder_path} ...")
+class FormatCache:
+    # manifest of the files formatted by previous runs, stored in the vault root.
+    # a file is skipped if its mtime and size haven't changed since it was last formatted.
+
+    def __init__(self, folder_path: str, do: list[Callable[[list[str]], list[str]]]):
+        self.folder_path = folder_path
+        self.dir_ = os.path.join(folder_path, CACHE_FILENAME)
+
+        # formatting anything differently invalidates the whole cache
+        self.rules = hashlib.sha1(repr((
+            CACHE_VERSION,
+            REPLACE_CHARS_RULES,
+            KEEP_WHITESPACE_AFTER_EMPTY_LI,
+            [do_.__name__ for do_ in do])).encode("utf-8")).hexdigest()
+
+        # relative path: [mtime_ns, size, digest of the formatted content]
+        self.files = {}
+        self.seen = set()
+
+        try:
+            with open(self.dir_, "r", encoding="utf-8") as file:
+                manifest = json.load(file)
+
+            if manifest.get("rules") == self.rules:
+                self.files = manifest["files"]
+
+        except (OSError, ValueError, KeyError):
+            # missing or broken; start over
+            pass
+
+    def key(self, dir_: str):
+        return os.path.relpath(dir_, self.folder_path).replace(os.sep, "/")
+
+    def is_fresh(self, dir_: str) -> bool:
+        key = self.key(dir_)
+        self.seen.add(key)
+
+        if key not in self.files:
+            return False
+
+        stat = os.stat(dir_)
+        mtime_ns, size, _ = self.files[key]
+
+        return stat.st_mtime_ns == mtime_ns and stat.st_size == size
+
+    def digest(self, dir_: str) -> str:
+        entry = self.files.get(self.key(dir_))
+        return entry[2] if entry else None
+
+    def update(self, dir_: str, digest: str, stat: os.stat_result = None):
+        if stat is None:
+            stat = os.stat(dir_)
+        self.files[self.key(dir_)] = [stat.st_mtime_ns, stat.st_size, digest]
+
+    def save(self, prune: bool = False):
+        # prune forgets files that weren't found this run, which is only known once the walk has finished
+        files = self.files
+        if prune:
+            files = {key: entry for key, entry in files.items() if key in self.seen}
+
+        with open(self.dir_, "w", encoding="utf-8") as file:
+            json.dump({"rules": self.rules, "files": files}, file)
+
+class FormatStats:
+    # what the transforms did, per file or summed over a run
+
+    def __init__(self):
+        self.files_changed = 0
+        self.chars_replaced = 0
+        self.lines_trimmed = 0
+        self.blanklines_removed = 0
+        self.blanklines_added = 0
+        self.paragraphs_merged = 0
+
+    def __str__(self):
+        return (f"{self.files_changed} files changed: "
+            + f"{self.chars_replaced} chars replaced, "
+            + f"{self.lines_trimmed} lines trimmed, "
+            + f"{self.blanklines_removed} blanklines removed, "
+            + f"{self.blanklines_added} blanklines added, "
+            + f"{self.paragraphs_merged} paragraphs merged")
+
+    def add(self, other: "FormatStats"):
+        for name, value in vars(other).items():
+            setattr(self, name, getattr(self, name) + value)
+
+class Profile:
+    # where the time of a run goes, for --profile.
+    # spans are (stage, dir_, pid, thread id, start, seconds, bytes, lines), where start is
+    # from time.perf_counter, the same clock in every process, and bytes and lines are those
+    # of the file the stage worked on. a "file" span covers everything done to a file in a worker.
+
+    def __init__(self):
+        self.spans = []
+        self.start = time.perf_counter()
+        self.seconds = None
+
+    def timed(self, stage: str, items: Iterable) -> Iterator:
+        # items, timing how long it takes to get each one
+        items = iter(items)
+        pid = os.getpid()
+        tid = threading.get_native_id()
+
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+
+            self.spans.append((stage, item[0], pid, tid, start, time.perf_counter() - start, 0, 0))
+            yield item
+
+    def stop(self):
+        self.seconds = time.perf_counter() - self.start
+
+    def report(self, top: int = 10) -> dict:
+        stages = {}
+        files = {}
+
+        for stage, dir_, _, _, _, seconds, n_bytes, n_lines in self.spans:
+            if stage == "file":
+                files[dir_] = {"file": dir_, "seconds": seconds, "bytes": n_bytes, "lines": n_lines, "stages": {}}
+                continue
+
+            totals = stages.setdefault(stage, {"seconds": 0.0, "count": 0, "bytes": 0, "lines": 0})
+            totals["seconds"] += seconds
+            totals["count"] += 1
+            totals["bytes"] += n_bytes
+            totals["lines"] += n_lines
+
+        for stage, dir_, _, _, _, seconds, _, _ in self.spans:
+            if stage != "file" and dir_ in files:
+                file_stages = files[dir_]["stages"]
+                file_stages[stage] = file_stages.get(stage, 0.0) + seconds
+
+        return {
+            "seconds": self.seconds,
+            "stages": stages,
+            "slowest": sorted(files.values(), key=lambda file: file["seconds"], reverse=True)[:top]}
+
+    def __str__(self):
+        report = self.report(PROFILE_TOP_N)
+        lines = [f"profile: {report['seconds']:.3f} s, stages summed over workers"]
+
+        for stage, totals in report["stages"].items():
+            line = f"  {stage:<26} {totals['seconds']:8.3f} s  {totals['count']:7} times"
+            if totals["bytes"]:
+                line += f"  {totals['bytes'] / totals['seconds'] / 1e6 if totals['seconds'] else 0:8.1f} MB/s"
+            lines.append(line)
+
+        lines.append("slowest files:")
+        for file in report["slowest"]:
+            lines.append(f"  {file['seconds']:8.3f} s  {file['file']} ({file['bytes']} bytes, {file['lines']} lines)")
+
+        return "\n".join(lines)
+
+    def save(self, dir_: str):
+        with open(dir_, "w", encoding="utf-8") as file:
+            json.dump(self.report(PROFILE_TOP_N), file, indent=2)
+
+    def save_trace(self, dir_: str):
+        # in the chrome trace event format, for chrome://tracing or perfetto
+        events = [{
+            "name": stage, "cat": "md_formatter", "ph": "X",
+            "ts": (start - self.start) * 1e6, "dur": seconds * 1e6,
+            "pid": pid, "tid": tid, "args": {"file": dir_}}
+            for stage, dir_, pid, tid, start, seconds, _, _ in self.spans]
+
+        with open(dir_, "w", encoding="utf-8") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+# whether to time the stages of formatting, in this process. set by set_profiling,
+# so that it's also set in workers that don't inherit it
+profiling = False
+# (stage, start, seconds, bytes, lines) of the file being formatted
+stage_spans = []
+
+def set_profiling(enabled: bool):
+    global profiling
+    profiling = enabled
+
+def init_worker(enabled: bool):
+    set_profiling(enabled)
+
+    # when on_all stops early, it terminates the pool. exiting through SystemExit rather
+    # than being killed outright lets format_file_streaming remove its temporary file
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+def batched(items: Iterable, n: int) -> Iterator[list]:
+    items = iter(items)
+    while batch := list(itertools.islice(items, n)):
+        yield batch
+
+def format_batch(entries: list[tuple[str, str, str]], format_entry: Callable) -> list:
+    return [format_entry(entry) for entry in entries]
+
+def remove_unwritten(pending: Iterable, batches) -> None:
+    # the temporary files of streamed results that came back from the pool but won't be
+    # written: those not handled yet, and the batches that came back after them
+    def results():
+        yield from pending
+
+        while True:
+            try:
+                yield from batches.next(timeout=0)
+            except (StopIteration, multiprocessing.TimeoutError):
+                return
+
+    for result in results():
+        # from format_file_profiled
+        if len(result) == 2:
+            result = result[0]
+
+        if isinstance(result[2], str):
+            remove_quietly(result[2])
+
+def add_span(stage: str, start: float, n_bytes: int = 0, n_lines: int = 0) -> float:
+    # times stage from start until now. returns now, to start the next stage from
+    now = time.perf_counter()
+    stage_spans.append((stage, start, now - start, n_bytes, n_lines))
+    return now
+
+def content_digest(lines: list[str]) -> str:
+    return hashlib.sha1("".join(lines).encode("utf-8")).hexdigest()
+
+def compile_ignore(ignore: list[str]):
+    # patterns are matched against the name and against the path relative to the root,
+    # so both "utdrag" and "dokumentation/*/2018" work
+    if not ignore:
+        return None
+
+    return re.compile("|".join(fnmatch.translate(pattern) for pattern in ignore))
+
+def walk(folder_path: str, ignore_folders: list[str]):
+    # yields (dir_, message) in the order the files should be reported.
+    # files to format have no message.
+    # ignore_folders are names or glob patterns of folders and files to skip.
+
+    ignore = compile_ignore(ignore_folders)
+
+    # (st_dev, st_ino) of every folder read, to not follow symlinks in circles
+    visited = set()
+
+    def read(dir_: str, rel_dir: str):
+        stat = os.stat(dir_)
+        visited.add((stat.st_dev, stat.st_ino))
 
-    for filename in os.listdir(folder_path):
-        dir_ = os.path.join(folder_path, filename)
+        with os.scandir(dir_) as it:
+            return iter(list(it)), rel_dir
+
+    yield folder_path, f"---\nreading {folder_path} ..."
+
+    # depth first, with a folder's content reported where the folder is found
+    stack = [read(folder_path, "")]
+
+    while stack:
+        entries, rel_folder = stack[-1]
+        entry = next(entries, None)
+
+        if entry is None:
+            stack.pop()
+            continue
+
+        filename = entry.name
+        dir_ = entry.path
 
         # skip hidden files and folders
         if filename[0] == ".":
-            print(f"skipping {dir_} (hidden)")
+            yield dir_, f"skipping {dir_} (hidden)"
             continue
 
         # skip non-markdown files
         dotindex = filename.rfind(".")
         if dotindex != -1 and filename[dotindex + 1:] != "md":
-            print(f"skipping {dir_} (not md)")
+            yield dir_, f"skipping {dir_} (not md)"
+            continue
+
+        rel_dir = rel_folder + filename
+        if ignore and (ignore.match(filename) or ignore.match(rel_dir)):
+            yield dir_, f"skipping {dir_} (ignored)"
+            continue
+
+        if entry.is_dir():
+            stat = entry.stat()
+
+            if (stat.st_dev, stat.st_ino) in visited:
+                yield dir_, f"skipping {dir_} (already read)"
+                continue
+
+            yield dir_, f"---\nreading {dir_} ..."
+
+            try:
+                stack.append(read(dir_, rel_dir + "/"))
+            except OSError:
+                yield dir_, f"couldn't read {dir_}"
+
             continue
 
+        yield dir_, None
+
+def format_file(entry: tuple[str, str, str], do: list[Callable[[list[str], FormatStats], list[str]]],
+    check: bool = False, diff: bool = False):
+
+    # returns (dir_, message, new_lines, digest, stats, stat), where new_lines is None if nothing has changed
+    # or if checking, and digest is the digest of the formatted content.
+    # stat is that of the file as it was read, to cache it by if it's unchanged: a stat taken
+    # later could be of an edit that wasn't read.
+    # files larger than STREAM_THRESHOLD are formatted line by line into a temporary file,
+    # and new_lines is then the path of that file instead.
+    # runs in a worker process when on_all is parallel, so it must not print or write to dir_.
+
+    dir_, message, known_digest = entry
+    stats = FormatStats()
+
+    if message is not None:
+        return dir_, message, None, None, stats, None
+
+    if profiling:
+        start = time.perf_counter()
+
+    with open(dir_, "r", encoding="utf-8") as file:
         try:
-            with open(dir_, "r", encoding="utf-8") as file:
-                try:
-                    lines = file.readlines()
-                    new_lines = lines
+            stat = os.fstat(file.fileno())
+            size = stat.st_size
 
-                    for do_ in do:
-                        new_lines = do_(new_lines)
+            if size > STREAM_THRESHOLD and all(do_ in iter_transforms for do_ in do):
+                result = format_file_streaming(file, dir_, do, check, diff)
+                if profiling:
+                    add_span("stream", start, size)
+                return result + (stat,)
 
-                    # only write if something has changed
-                    if new_lines != lines:
-                        write_lines(new_lines, dir_)
+            lines = file.readlines()
+        except UnicodeDecodeError:
+            # probably not a text file
+            return dir_, f"couldn't decode {dir_}", None, None, stats, None
 
-                except UnicodeDecodeError:
-                    # probably not a text file
-                    print(f"couldn't decode {dir_}")
-                    continue
+    if profiling:
+        add_span("read", start, size, len(lines))
+
+    digest = None
+
+    if known_digest is not None:
+        # touched but not edited since it was last formatted
+        digest = content_digest(lines)
+        if digest == known_digest:
+            return dir_, None, None, digest, stats, stat
+
+    new_lines = lines
+
+    for do_ in do:
+        new_lines = do_(new_lines, stats)
+
+    # only write if something has changed
+    if new_lines == lines:
+        return dir_, None, None, digest or content_digest(lines), FormatStats(), stat
+
+    stats.files_changed = 1
+
+    if check:
+        message = f"would write {dir_} ..."
+        if diff:
+            if profiling:
+                start = time.perf_counter()
+
+            message += "\n" + "".join(difflib.unified_diff(lines, new_lines, dir_, dir_)).rstrip("\n")
+
+            if profiling:
+                add_span("diff", start)
+
+        return dir_, message, None, None, stats, stat
+
+    return dir_, None, new_lines, content_digest(new_lines), stats, stat
+
+def format_file_profiled(entry: tuple[str, str, str], do: list[Callable[[list[str], FormatStats], list[str]]],
+    check: bool = False, diff: bool = False):
+
+    # (format_file, its spans); see Profile
+    stage_spans.clear()
+
+    start = time.perf_counter()
+    result = format_file(entry, do, check, diff)
+    seconds = time.perf_counter() - start
+
+    dir_, message, _ = entry
+    if message is not None:
+        return result, []
+
+    pid = os.getpid()
+    tid = threading.get_native_id()
+
+    # the size of the file, from when it was read
+    n_bytes = max((span[3] for span in stage_spans), default=0)
+    n_lines = max((span[4] for span in stage_spans), default=0)
+
+    spans = [("file", dir_, pid, tid, start, seconds, n_bytes, n_lines)]
+    for stage, stage_start, stage_seconds, _, _ in stage_spans:
+        spans.append((stage, dir_, pid, tid, stage_start, stage_seconds, n_bytes, n_lines))
+
+    return result, spans
+
+def format_file_streaming(file, dir_: str, do: list[Callable[[list[str], FormatStats], list[str]]],
+    check: bool = False, diff: bool = False):
+
+    # format_file for a file too large to read at once. only the lines of the current
+    # paragraph are held in memory, and whether the file has changed is known from
+    # the digests once it has been written. returns what format_file does, except the stat,
+    # which format_file adds.
+
+    stats = FormatStats()
+    digest = hashlib.sha1()
+    new_digest = hashlib.sha1()
+
+    def read():
+        for line in file:
+            digest.update(line.encode("utf-8"))
+            yield line
+
+    lines = read()
+    for do_ in do:
+        lines = iter_transforms[do_](lines, stats)
+
+    tmp_dir = None
+
+    try:
+        if check:
+            for line in lines:
+                new_digest.update(line.encode("utf-8"))
+        else:
+            fd, tmp_dir = mkstemp_next_to(dir_)
 
-        except PermissionError:
-            # we hit a folder; recurse
-            if not filename in ignore_folders:
-                on_all(dir_, ignore_folders, do)
-            else: print(f"skipping {dir_} (ignored)")
+            with open(fd, "w", encoding="utf-8") as tmp_file:
+                for line in lines:
+                    new_digest.update(line.encode("utf-8"))
+                    tmp_file.write(line)
+
+    except BaseException:
+        if tmp_dir is not None:
+            remove_quietly(tmp_dir)
+        raise
+
+    # only write if something has changed
+    if new_digest.digest() == digest.digest():
+        if tmp_dir is not None:
+            remove_quietly(tmp_dir)
+        return dir_, None, None, new_digest.hexdigest(), FormatStats()
+
+    stats.files_changed = 1
+
+    if check:
+        message = f"would write {dir_} ..."
+        if diff:
+            message += " (too large to diff)"
+
+        return dir_, message, None, None, stats
+
+    return dir_, None, tmp_dir, new_digest.hexdigest(), stats
+
+def on_all(folder_path: str, ignore_folders: list[str], do: list[Callable[[list[str], FormatStats], list[str]]],
+    workers: int = None, cache: FormatCache = None, check: bool = False, diff: bool = False,
+    writer: Writer = None, profile: Profile = None) -> FormatStats:
+
+    # workers defaults to the number of cores; 1 formats in this process.
+    # when checking, nothing is written; diff also prints what would change.
+    # if profile is given, the time of every stage is added to it.
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if writer is None:
+        writer = Writer()
+
+    def entries():
+        for dir_, message in walk(folder_path, ignore_folders):
+            if message is not None or cache is None:
+                yield dir_, message, None
+            elif not cache.is_fresh(dir_):
+                yield dir_, message, cache.digest(dir_)
+
+    format_entry = functools.partial(format_file_profiled if profile else format_file, do=do, check=check, diff=diff)
+    total_stats = FormatStats()
+
+    set_profiling(profile is not None)
+    pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(profile is not None,)) if workers > 1 else None
+
+    entries_ = profile.timed("walk", entries()) if profile else entries()
+
+    # imap keeps the order of the walk, so the log is the same as when serial.
+    # batched by hand rather than with chunksize, to keep hold of imap's iterator,
+    # and of the results of a batch not handled yet, in case on_all stops early
+    batches = None
+    pending = []
+
+    def flatten():
+        for batch in batches:
+            pending[:] = batch[::-1]
+            while pending:
+                yield pending.pop()
+
+    if pool:
+        batches = pool.imap(functools.partial(format_batch, format_entry=format_entry), batched(entries_, BATCH_SIZE))
+        results = flatten()
+    else:
+        results = map(format_entry, entries_)
+
+    # files being written can only be cached once they are
+    written_digests = {}
+    # whether the whole walk was handled, and the cache can forget the files not in it
+    walked = False
+
+    try:
+        for result in results:
+            if profile:
+                result, spans = result
+                profile.spans += spans
+
+            dir_, message, new_lines, digest, stats, stat = result
+            total_stats.add(stats)
+
+            if message is not None:
+                print(message)
+                continue
+
+            if isinstance(new_lines, str):
+                writer.write_from(new_lines, dir_)
+                written_digests[dir_] = digest
+            elif new_lines is not None:
+                writer.write_lines(new_lines, dir_)
+                written_digests[dir_] = digest
+            elif cache is not None:
+                cache.update(dir_, digest, stat)
+    except BaseException:
+        # don't wait for the rest of the walk to be formatted
+        if pool:
+            pool.terminate()
+            pool.join()
+            remove_unwritten(pending, batches)
+        raise
+    else:
+        if pool:
+            pool.close()
+            pool.join()
+        walked = True
+    finally:
+        set_profiling(False)
+
+        try:
+            writer.close()
+        finally:
+            # a check only reads the cache; it doesn't write anything to the vault
+            if cache is not None and not check:
+                for dir_, stat in writer.written:
+                    cache.update(dir_, written_digests[dir_], stat)
+                cache.save(prune=walked)
+
+    if writer.written:
+        print(f"---\n{writer}")
+
+    return total_stats
 
 # format
 
-def format_blanklines(lines: list[str]) -> list[str]:
+def format_blanklines(lines: list[str], stats: FormatStats = None) -> list[str]:
+    return format_document_blanklines(parse_document(lines), stats)
+
+def format_document_blanklines(document: Document, stats: FormatStats = None) -> list[str]:
+    # format_blanklines_iter, block by block
+
+    stats = stats or FormatStats()
+
+    lines = document.lines
+    kinds = document.kinds
+    n = len(lines)
+
+    # remove leading blanklines
+    stats.blanklines_removed += document.text_start
     new_lines = []
 
-    # needed for merging multiple paragraphs
-    lines.append("\n")
+    for block_kind, start, end in document.blocks:
+        if end <= document.text_start:
+            continue
+
+        # don't format frontmatter, codeblocks and tables.
+        # lists are never followed by an added blankline
+        if block_kind in BlockKind.AS_IS:
+            new_lines += lines[start:end]
+            continue
+
+        # remove double blanklines. the end counts as a blankline
+        if block_kind == BlockKind.BLANK:
+            if end == n:
+                stats.blanklines_removed += end - start
+            else:
+                stats.blanklines_removed += end - start - 1
+                new_lines.append(lines[end - 1])
+            continue
+
+        # every other block is a single line, or a paragraph to merge into one:
+        # if multiple consecutive lines are normal paragraphs,
+        # they are probably meant to be one paragraph and not many.
+        if end - start > 1:
+            parts = [lines[start]]
+
+            for line_next in lines[start + 1:end]:
+                rstrip_parts(parts)
+                parts.append(" ")
+                parts.append(line_next.lstrip())
+
+            stats.paragraphs_merged += end - start - 1
+
+            line = "".join(parts)
+            kind = classify_line(line)
+        else:
+            line = lines[start]
+            kind = kinds[start]
+
+        new_lines.append(line)
+
+        if needs_blankline(line, kind, kinds[end] if end < n else LineKind.NL):
+            stats.blanklines_added += 1
+            new_lines.append("\n")
+
+    return new_lines
+
+def format_blanklines_iter(lines: Iterable[str], stats: FormatStats = None) -> Iterator[str]:
+    # one pass over the lines, looking ahead only as far as the current paragraph.
+    # every line is classified once.
+
+    lines = iter(lines)
+    stats = stats or FormatStats()
 
     is_first_text_found = False
     is_in_frontmatter = False
     is_in_code_block = False
-    line_next_already_added = 0
 
-    for i in range(len(lines) - 1):
-        if line_next_already_added > 0:
-            line_next_already_added -= 1
-            continue
+    line = next(lines, None)
+    kind = classify_line(line) if line is not None else None
 
-        line = lines[i]
-        line_next = lines[i + 1]
+    while line is not None:
+        # the end counts as a blankline, which is needed for merging multiple paragraphs
+        line_next = next(lines, None)
+        kind_next = classify_line(line_next) if line_next is not None else LineKind.NL
 
         if not is_first_text_found:
             # remove leading blanklines
             if line == "\n":
+                stats.blanklines_removed += 1
+                line, kind = line_next, kind_next
                 continue
             else:
                 is_first_text_found = True
@@ -200,218 +1223,708 @@ def format_blanklines(lines: list[str]) -> list[str]:
                 # look for frontmatter
                 if line.strip() == "---":
                     is_in_frontmatter = True
-                    new_lines.append(line)
+                    yield line
+                    line, kind = line_next, kind_next
                     continue
 
         # don't format frontmatter
         if is_in_frontmatter:
             if line.strip() == "---":
                 is_in_frontmatter = False
-            new_lines.append(line)
+            yield line
+            line, kind = line_next, kind_next
             continue
 
         # don't format codeblocks
-        if line.strip()[:3] == "```":
+        if kind & LineKind.CODEBLOCK_FENCE:
             is_in_code_block = not is_in_code_block
-            new_lines.append(line)
+            yield line
+            line, kind = line_next, kind_next
             continue
-        if is_in_code_block or (len(line) > 4 and line[:4] == "    "):
-            new_lines.append(line)
+        if is_in_code_block or is_indented(line):
+            yield line
+            line, kind = line_next, kind_next
             continue
 
         # don't format tables
-        if is_tr(line):
-            new_lines.append(line)
+        if kind & LineKind.TR:
+            yield line
+            line, kind = line_next, kind_next
             continue
 
         # if multiple consecutive lines are normal paragraphs,
         # they are probably meant to be one paragraph and not many.
-        if is_p(line) and not is_forcing_nl(line):
-            line_concat = line
-            n_merged = 0
+        if kind & LineKind.P and not kind & LineKind.FORCING_NL and kind_next & LineKind.P:
+            parts = [line]
 
             # concate consecutive lines
-            for j in range(i + 1, len(lines) - 1):
-                if is_p(lines[j]):
-                    line_concat = line_concat.rstrip() + " " + line_next.lstrip()
-                    n_merged += 1
-                else:
-                    break
+            while line_next is not None and kind_next & LineKind.P:
+                rstrip_parts(parts)
+                parts.append(" ")
+                parts.append(line_next.lstrip())
+                stats.paragraphs_merged += 1
 
-            line = line_concat
-            line_next = lines[i + 1 + n_merged]
-            line_next_already_added += n_merged
+                line_next = next(lines, None)
+                kind_next = classify_line(line_next) if line_next is not None else LineKind.NL
 
-        # remove double blanklines
-        if not (is_nl(line) and is_nl(line_next)):
-            new_lines.append(line)
-
-        # add blanklines after everything except
-        # - lists
-        # - backslashes
-        # - multi-line footnotes with lists
-        if (
-            len(line) >= 1
-            and not is_nl(line) and not is_nl(line_next)
-            and not is_li(line) and not is_blockquote(line)
-            and not is_forcing_nl(line)
-            and not (is_footnote(line) and is_li(line_next))):
+            line = "".join(parts)
+            kind = classify_line(line)
 
-            new_lines.append("\n")
+        # remove double blanklines
+        if not (kind & LineKind.NL and kind_next & LineKind.NL):
+            yield line
+        else:
+            stats.blanklines_removed += 1
+
+        if needs_blankline(line, kind, kind_next):
+            stats.blanklines_added += 1
+            yield "\n"
+
+        line, kind = line_next, kind_next
+
+def needs_blankline(line: str, kind: int, kind_next: int) -> bool:
+    # add blanklines after everything except
+    # - lists
+    # - backslashes
+    # - multi-line footnotes with lists
+    return bool(
+        len(line) >= 1
+        and not kind & LineKind.NL and not kind_next & LineKind.NL
+        and not kind & LineKind.LI and not kind & LineKind.BLOCKQUOTE
+        and not kind & LineKind.FORCING_NL
+        and not (kind & LineKind.FOOTNOTE and kind_next & LineKind.LI))
+
+def rstrip_parts(parts: list[str]):
+    # parts[-1] = "".join(parts).rstrip(), without joining
+    while True:
+        last = parts.pop().rstrip()
+        if last or not parts:
+            parts.append(last)
+            return
 
-    # add last line
-    if len(lines) > 0 and lines[-1] != "\n":
-        # strip and add nl to keep empty files one line long
-        new_lines.append(lines[-1].rstrip() + "\n")
+def trim_trailing_whitespace(lines: list[str], stats: FormatStats = None) -> list[str]:
+    return list(trim_trailing_whitespace_iter(lines, stats))
 
-    return new_lines
+def trim_trailing_whitespace_iter(lines: Iterable[str], stats: FormatStats = None,
+    kinds: list[int] = None) -> Iterator[str]:
 
-def trim_trailing_whitespace(lines: list[str]) -> list[str]:
-    # also makes sure the files ends with a blankline
+    # also makes sure the files ends with a blankline.
+    # if kinds is given, the kind of every trimmed line is appended to it,
+    # since they are classified here anyway.
 
-    new_lines = []
+    stats = stats or FormatStats()
+    keep_whitespace = KEEP_WHITESPACE_AFTER_EMPTY_LI
+    li = LineKind.UL_LI | LineKind.UL_CB | LineKind.OL_LI | LineKind.DV_INLINE_FIELD
 
     for line in lines:
+        raw = line
         line = line.rstrip()
         line_ending = "\n"
+        kind = LineKind.NL
 
-        # keep whitespace after empty list item
-        if KEEP_WHITESPACE_AFTER_EMPTY_LI:
-            is_empty_ul_li = len(line) == 1 and is_ul_li(line)
-            is_empty_ul_cb = len(line) == 5 and is_ul_cb(line)
-            is_empty_ol_li = is_ol_li(line) and len(line[line.find("."):]) == 1
-            is_empty_dv_inline_field = is_dv_inline_field(line) and len(line[line.find("::"):]) == 2
+        # the line ending doesn't change the kind of a line that isn't blank
+        if line and (keep_whitespace or kinds is not None):
+            kind = classify_line(line)
 
-            if is_empty_ul_li or is_empty_ul_cb or is_empty_ol_li or is_empty_dv_inline_field:
-                line_ending = " " + line_ending
+            # keep whitespace after empty list item
+            if keep_whitespace and kind & li:
+                is_empty_ul_li = len(line) == 1 and kind & LineKind.UL_LI
+                is_empty_ul_cb = len(line) == 5 and kind & LineKind.UL_CB
+                is_empty_ol_li = kind & LineKind.OL_LI and len(line[line.find("."):]) == 1
+                is_empty_dv_inline_field = kind & LineKind.DV_INLINE_FIELD and len(line[line.find("::"):]) == 2
 
-        new_lines.append(line + line_ending)
+                if is_empty_ul_li or is_empty_ul_cb or is_empty_ol_li or is_empty_dv_inline_field:
+                    line_ending = " " + line_ending
 
-    return new_lines
+        line += line_ending
 
-def replace_chars(lines: list[str]) -> list[str]:
-    new_lines = []
+        # lines without a line ending are only given one
+        if line != raw and line[:-1] != raw:
+            stats.lines_trimmed += 1
+
+        if kinds is not None:
+            kinds.append(kind)
+
+        yield line
+
+def replace_chars(lines: list[str], stats: FormatStats = None) -> list[str]:
+    return list(replace_chars_iter(lines, stats))
+
+def replace_chars_iter(lines: Iterable[str], stats: FormatStats = None) -> Iterator[str]:
+    stats = stats or FormatStats()
+    rules = REPLACE_CHARS_RULES
 
     for line in lines:
-        for rule in REPLACE_CHARS_RULES:
-            line = line.replace(rule[0], rule[1])
+        for rule in rules:
+            n = line.count(rule[0])
+            if n:
+                stats.chars_replaced += n
+                line = line.replace(rule[0], rule[1])
 
-        new_lines.append(line)
+        yield line
+
+def format_lines(lines: list[str], stats: FormatStats = None) -> list[str]:
+    # replace_chars, trim_trailing_whitespace and format_blanklines in one pass,
+    # for lines as read by readlines.
+
+    stats = stats or FormatStats()
+
+    if any("\n" in rule[0] or "\n" in rule[1] for rule in REPLACE_CHARS_RULES):
+        return format_blanklines(list(trim_trailing_whitespace_iter(replace_chars_iter(lines, stats), stats)), stats)
+
+    if profiling:
+        start = time.perf_counter()
+
+    # replacing in the whole text is much faster than line by line,
+    # and the same as long as no rule spans or adds lines
+    text = "".join(lines)
+    for rule in REPLACE_CHARS_RULES:
+        n = text.count(rule[0])
+        if n:
+            stats.chars_replaced += n
+            text = text.replace(rule[0], rule[1])
+
+    # trim_trailing_whitespace adds the line endings back
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+
+    if profiling:
+        start = add_span("replace_chars", start)
+
+    kinds = []
+    lines = list(trim_trailing_whitespace_iter(lines, stats, kinds))
+
+    if profiling:
+        start = add_span("trim_trailing_whitespace", start)
+
+    # parsed right away rather than through parse_document, since these lines are new
+    # and hashing them to look them up costs more than it saves
+    document = Document(lines, kinds)
+
+    if profiling:
+        start = add_span("parse", start)
+
+    new_lines = format_document_blanklines(document, stats)
+
+    if profiling:
+        add_span("format_blanklines", start)
 
     return new_lines
 
-def format(folder_path: str, ignore_folders: list[str]):
-    print(f"\nFormatting {folder_path}\n---")
+def format_lines_iter(lines: Iterable[str], stats: FormatStats = None) -> Iterator[str]:
+    # format_lines, one line at a time
+    stats = stats or FormatStats()
+    return format_blanklines_iter(trim_trailing_whitespace_iter(replace_chars_iter(lines, stats), stats), stats)
 
-    # order is important
-    on_all(folder_path, ignore_folders, [replace_chars, trim_trailing_whitespace, format_blanklines])
+# the streaming version of each transform, for files larger than STREAM_THRESHOLD
+iter_transforms = {
+    format_blanklines: format_blanklines_iter,
+    trim_trailing_whitespace: trim_trailing_whitespace_iter,
+    replace_chars: replace_chars_iter,
+    format_lines: format_lines_iter}
 
-    print("---\nDone!\n")
+def format(folder_path: str, ignore_folders: list[str], workers: int = None, use_cache: bool = True,
+    check: bool = False, diff: bool = False, fsync: str = "none", profile: Profile = None) -> FormatStats:
 
-# external
+    print(f"\n{'Checking' if check else 'Formatting'} {folder_path}\n---")
 
-def embed_gdoc_comments(path: str, filename: str):
-    dir_ = path + filename
+    do = [format_lines]
+    cache = FormatCache(folder_path, do) if use_cache else None
 
-    print("reading ...")
-    print("---")
+    writer = Writer(fsync, background=BACKGROUND_WRITES, profile=profile)
+
+    stats = on_all(folder_path, ignore_folders, do, workers, cache, check, diff, writer, profile)
+
+    print(f"---\n{stats}")
+
+    if profile:
+        profile.stop()
+        print(f"---\n{profile}")
+    print("Done!\n")
+
+    return stats
+
+# watch
+
+def watch(folder_path: str, ignore_folders: list[str], workers: int = None, use_cache: bool = True,
+    fsync: str = "none"):
+    # formats the whole folder once, then notes as they are saved, until interrupted
+
+    ignore = compile_ignore(ignore_folders)
+    do = [format_lines]
+
+    # watching starts first, so that notes saved during the first pass aren't missed
+    changes = queue.Queue()
+    stop = watch_changes(folder_path, ignore_folders, changes)
+
+    # dir_: time of the last change, to wait for bursts of saves to end
+    pending = {}
+    # dir_: (mtime_ns, size) of what we wrote, so that our own writes aren't formatted again
+    own_writes = {}
+
+    try:
+        format(folder_path, ignore_folders, workers, use_cache, fsync=fsync)
+
+        print(f"\nWatching {folder_path}\n---")
+
+        while True:
+            timeout = None
+            if pending:
+                timeout = max(0, min(pending.values()) + WATCH_DEBOUNCE - time.monotonic())
+
+            # due notes are formatted after every event too, or a steady stream of
+            # other events would keep them waiting
+            try:
+                dir_ = changes.get(timeout=timeout)
+                if is_note(dir_, folder_path, ignore):
+                    pending[dir_] = time.monotonic()
+            except queue.Empty:
+                pass
+
+            now = time.monotonic()
+            for dir_ in [dir_ for dir_, changed in pending.items() if now - changed >= WATCH_DEBOUNCE]:
+                del pending[dir_]
+
+                try:
+                    stat = os.stat(dir_)
+                except FileNotFoundError:
+                    own_writes.pop(dir_, None)
+                    continue
+
+                if own_writes.get(dir_) == (stat.st_mtime_ns, stat.st_size):
+                    continue
+
+                # a note that can't be read or written now is left, and tried again when next saved
+                try:
+                    _, message, new_lines, _, _, _ = format_file((dir_, None, None), do)
+
+                    if message is not None:
+                        print(message)
+                    elif isinstance(new_lines, str):
+                        stat = write_from(new_lines, dir_)
+                        own_writes[dir_] = (stat.st_mtime_ns, stat.st_size)
+                    elif new_lines is not None:
+                        stat = write_lines(new_lines, dir_)
+                        own_writes[dir_] = (stat.st_mtime_ns, stat.st_size)
+                except OSError as error:
+                    print(f"skipping {dir_} ({error})")
+
+    except KeyboardInterrupt:
+        print("---\nStopped!\n")
+
+    finally:
+        stop()
+
+def is_note(dir_: str, folder_path: str, ignore: re.Pattern) -> bool:
+    # whether walk would format dir_
+    rel_dir = os.path.relpath(dir_, folder_path).replace(os.sep, "/")
+    if rel_dir.startswith("../"):
+        return False
+
+    parts = rel_dir.split("/")
+
+    for i, filename in enumerate(parts):
+        dotindex = filename.rfind(".")
+
+        if (filename[0] == "."
+            or (dotindex != -1 and filename[dotindex + 1:] != "md")
+            or (ignore and (ignore.match(filename) or ignore.match("/".join(parts[:i + 1]))))):
+            return False
+
+    return True
+
+def watch_changes(folder_path: str, ignore_folders: list[str], changes: queue.Queue) -> Callable[[], None]:
+    # puts the paths of changed files in changes. returns a function that stops watching.
+    # uses the filesystem's events (inotify on linux) if watchdog is installed, otherwise polls.
+
+    try:
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+    except ImportError:
+        print("watchdog not installed; polling")
+        return poll_changes(folder_path, ignore_folders, changes)
+
+    class Handler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            # not opened or closed without writing, which reading a note also causes
+            if event.is_directory or event.event_type not in ["created", "modified", "moved", "closed"]:
+                return
+
+            changes.put(event.src_path)
+
+            # saved by moving a temporary file into place
+            dest_path = getattr(event, "dest_path", None)
+            if dest_path:
+                changes.put(dest_path)
+
+    observer = Observer()
+    observer.schedule(Handler(), folder_path, recursive=True)
+    observer.start()
+
+    def stop():
+        observer.stop()
+        observer.join()
+
+    return stop
+
+def poll_changes(folder_path: str, ignore_folders: list[str], changes: queue.Queue) -> Callable[[], None]:
+    stopped = threading.Event()
+
+    def stat_all() -> dict:
+        stats = {}
+        for dir_, message in walk(folder_path, ignore_folders):
+            if message is None:
+                try:
+                    stat = os.stat(dir_)
+                    stats[dir_] = (stat.st_mtime_ns, stat.st_size)
+                except FileNotFoundError:
+                    pass
+        return stats
+
+    def run():
+        stats = stat_all()
+
+        while not stopped.wait(WATCH_POLL_INTERVAL):
+            new_stats = stat_all()
+
+            for dir_, stat in new_stats.items():
+                if stats.get(dir_) != stat:
+                    changes.put(dir_)
+
+            stats = new_stats
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    def stop():
+        stopped.set()
+        thread.join()
+
+    return stop
 
-    letters0 = list("abcdefghijklmnopqrstuvwxyz")
-    letters0.insert(0,"")
-    n = 26
+# links
 
-    # go backwards to easily retreive the last comment
-    # – since it ends with the end of the file
-    for i in reversed(range(n ** 2 + n)):
-        c0 = letters0[i // n]
-        c1 = letters[i % n]
-        tag = "[" + c0 + c1 + "]"
+class LinkIndex:
+    # the links of every note, stored in the vault root and updated by mtime like FormatCache,
+    # for finding and renaming links to a note without reading the whole vault
 
-        new_text = ""
+    def __init__(self, folder_path: str, ignore_folders: list[str]):
+        self.folder_path = folder_path
+        self.ignore_folders = ignore_folders
+        self.dir_ = os.path.join(folder_path, LINK_INDEX_FILENAME)
 
-        with open(dir_, "r", encoding="utf-8") as file:
-            text = file.read()
-            l_index = text.find(tag)
-            r_index = text.rfind(tag)
+        # relative path: [mtime_ns, size, find_links of the note]
+        self.files = {}
+        # link_key: [(relative path, line index, column)], built when first asked for
+        self.links_to = None
 
-            if l_index == -1 or r_index == -1:
+        try:
+            with open(self.dir_, "r", encoding="utf-8") as file:
+                index = json.load(file)
+
+            if index.get("version") == LINK_INDEX_VERSION:
+                self.files = index["files"]
+
+        except (OSError, ValueError, KeyError):
+            # missing or broken; start over
+            pass
+
+    def key(self, dir_: str):
+        return os.path.relpath(dir_, self.folder_path).replace(os.sep, "/")
+
+    def update(self) -> int:
+        # reads the notes that have changed since the last update and forgets removed ones.
+        # returns the number of notes read
+        files = {}
+        n_read = 0
+
+        for dir_, message in walk(self.folder_path, self.ignore_folders):
+            if message is not None:
+                continue
+
+            key = self.key(dir_)
+
+            # before reading, so that a note changed while it's read is read again next time
+            stat = os.stat(dir_)
+            entry = self.files.get(key)
+
+            if entry is not None and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+                files[key] = entry
                 continue
 
-            print(tag, "at", l_index, "and", r_index)
+            with open(dir_, "r", encoding="utf-8") as file:
+                try:
+                    lines = file.readlines()
+                except UnicodeDecodeError:
+                    continue
+
+            files[key] = [stat.st_mtime_ns, stat.st_size, find_links(lines)]
+            n_read += 1
+
+        self.files = files
+        self.links_to = None
+
+        return n_read
+
+    def save(self):
+        with open(self.dir_, "w", encoding="utf-8") as file:
+            json.dump({"version": LINK_INDEX_VERSION, "files": self.files}, file)
 
-            # remove tag
-            new_text = text[:l_index] + text[l_index + len(tag):]
+    def backlinks(self, name: str) -> list[tuple[str, int, int]]:
+        # (relative path, line index, column) of every link to the note name
+        if self.links_to is None:
+            self.links_to = {}
 
-            # by default, insert comment at end of file
-            bl_index = len(text) - 1
+            for key, (_, _, links) in self.files.items():
+                for target, _, i, column in links:
+                    self.links_to.setdefault(link_key(target), []).append((key, i, column))
 
-            for char_index in range(l_index + len(tag), len(text)):
-                # find a blank line
-                if text[char_index:char_index + 2] == "\n\n":
-                    bl_index = char_index
-                    print("blank line at", bl_index)
-                    break
+        return self.links_to.get(link_key(name), [])
 
-            # since we have removed the tag
-            bl_index = bl_index - len(tag)
+    def rename_links(self, renames: dict[str, str]) -> int:
+        # points the links to the notes named like the keys of renames to the values instead,
+        # keeping folders, headings and aliases. update should be called first.
+        # returns the number of links changed
 
-            # retreive comment
-            comment = text[r_index + len(tag):]
+        renames = {link_key(old_name): link_key(new_name) for old_name, new_name in renames.items()}
+        n_renamed = 0
 
-            # remove comment from bottom
-            new_text = new_text[:r_index - len(tag)]
-            # insert comment at blank line nearest tag
-            # +2 to get between the newlines
-            new_text = new_text[:bl_index + 2] + comment + new_text[bl_index + 2:]
+        def rename(match: re.Match) -> str:
+            nonlocal n_renamed
 
+            target = match.group(1)
+            new_name = renames.get(link_key(target))
+            if new_name is None:
+                return match.group()
+
+            n_renamed += 1
+
+            path = target.split("#", 1)[0]
+            folder = path[:path.rfind("/") + 1]
+            extension = ".md" if path.endswith(".md") else ""
+
+            return "[[" + folder + new_name + extension + target[len(path):] + match.group()[2 + len(target):]
+
+        # only the lines with links to rename are read again
+        line_indices = {}
+        for old_name in renames:
+            for key, i, _ in self.backlinks(old_name):
+                line_indices.setdefault(key, set()).add(i)
+
+        for key, indices in line_indices.items():
+            dir_ = os.path.join(self.folder_path, key)
+
+            with open(dir_, "r", encoding="utf-8") as file:
+                lines = file.readlines()
+
+            for i in indices:
+                if i < len(lines):
+                    lines[i] = link_pattern.sub(rename, lines[i])
+
+            stat = write_lines(lines, dir_)
+            self.files[key] = [stat.st_mtime_ns, stat.st_size, find_links(lines)]
+
+        self.links_to = None
+
+        return n_renamed
+
+# external
+
+def embed_gdoc_comments(path: str, filename: str):
+    dir_ = path + filename
+
+    print("reading ...")
+    print("---")
+
+    with open(dir_, "r", encoding="utf-8") as file:
+        text = file.read()
+
+    new_text = embed_comments(text)
+
+    if new_text != text:
         write(new_text, dir_)
 
     print("---")
     print("done!")
 
-def embed_dreams(days_folder_path: str, dreams_folder_path: str):
+def gdoc_tag_index(tag: str) -> int:
+    # [a] ... [z], [aa] ... [zz]
+    name = tag[1:-1]
+    if len(name) == 1:
+        return ord(name) - ord("a")
+    return (ord(name[0]) - ord("a") + 1) * 26 + ord(name[1]) - ord("a")
+
+def embed_comments(text: str) -> str:
+    # moves the comments at the bottom of a google docs export to the blank line after where they are tagged.
+    # tags appear twice: once in the text and once in front of the comment.
+
+    # find every tag at once
+    positions = {}
+    for match in gdoc_tag_pattern.finditer(text):
+        positions.setdefault(match.group(), []).append(match.start())
+
+    tags = []
+    for tag, indices in positions.items():
+        if len(indices) != 2:
+            print(tag, "found", len(indices), "times; skipping")
+            continue
+        tags.append((gdoc_tag_index(tag), tag, indices[0], indices[1]))
+
+    if not tags:
+        return text
+
+    tags.sort()
+
+    # the comments are listed in order at the bottom, after all tags in the text
+    for k in range(len(tags) - 1):
+        if tags[k][3] > tags[k + 1][3]:
+            print("comments not in order; aborting")
+            return text
+
+    first_comment_index = tags[0][3]
+    if any(l_index > first_comment_index for _, _, l_index, _ in tags):
+        print("tags after the first comment; aborting")
+        return text
+
+    # tags later in the alphabet have already been removed when a tag is handled,
+    # so a line with only such tags on it counts as blank
+    tags_by_l_index = {l_index: k for k, (_, _, l_index, _) in enumerate(tags)}
+    l_indices = sorted(tags_by_l_index)
+
+    def find_blankline_end(start: int, end: int, k: int) -> int:
+        bl_index = text.find("\n\n", start, end)
+        limit = bl_index if bl_index != -1 else end
+
+        i = bisect.bisect_left(l_indices, start)
+        while i < len(l_indices) and l_indices[i] < limit:
+            run_start = run_end = l_indices[i]
+
+            # consecutive removed tags
+            while run_end in tags_by_l_index and tags_by_l_index[run_end] > k:
+                run_end += len(tags[tags_by_l_index[run_end]][1])
+                i += 1
+
+            if (run_end > run_start and run_start - 1 >= start and text[run_start - 1] == "\n"
+                and run_end < end and text[run_end] == "\n"):
+                return run_end + 1
+
+            if run_end == run_start:
+                i += 1
+
+        return bl_index + 2 if bl_index != -1 else -1
+
+    # comments to insert at an index, in order
+    insertions = {}
+    # a comment runs until the next comment tag
+    comment_ends = [tags[k + 1][3] for k in range(len(tags) - 1)] + [len(text)]
+
+    # go backwards, since the last comment ends with the end of the file.
+    # each comment is inserted at the blank line nearest after its tag, which is before any
+    # comment already inserted there. if there is none before the comment itself,
+    # it ends up after the comment before it.
+    for k in reversed(range(len(tags))):
+        _, tag, l_index, r_index = tags[k]
+        print(tag, "at", l_index, "and", r_index)
+
+        # the index between the newlines
+        bl_end_index = find_blankline_end(l_index + len(tag), comment_ends[k], k)
+
+        if bl_end_index != -1 and bl_end_index <= r_index:
+            print("blank line at", bl_end_index - 2)
+            insertions.setdefault(bl_end_index, []).insert(0, k)
+        else:
+            insertions.setdefault(r_index, []).append(k)
+
+    # text and comments with every tag removed and every comment inserted
+    cuts = sorted([(index, 0) for index in insertions] + [(tag[2], 1) for tag in tags])
+    cut_indices = [cut[0] for cut in cuts]
+
+    def build(start: int, end: int, new_text: list[str]):
+        # comments inserted at end belong here
+        index = start
+        for i in range(bisect.bisect_left(cut_indices, start), bisect.bisect_right(cut_indices, end)):
+            cut_index, is_tag = cuts[i]
+
+            new_text.append(text[index:cut_index])
+            index = cut_index
+
+            if is_tag:
+                index += len(tags[tags_by_l_index[cut_index]][1])
+            else:
+                for k in insertions[cut_index]:
+                    build(tags[k][3] + len(tags[k][1]), comment_ends[k], new_text)
+
+        new_text.append(text[index:end])
+
+    new_text = []
+    build(0, first_comment_index, new_text)
+
+    return "".join(new_text)
+
+def embed_dreams(days_folder_path: str, dreams_folder_path: str, since: str = None):
+    # since is a date, YYYY-MM-dd; older dreams are skipped.
+
     print("searching ...")
 
-    dreams = os.listdir(dreams_folder_path)
-    days = os.listdir(days_folder_path)
+    # the first day of every date
+    days = {}
+    for day in os.listdir(days_folder_path):
+        days.setdefault(day[:len("YYYY-MM-dd")], day)
 
-    for dream in dreams:
+    # dreams in the order they are found, grouped by day
+    dreams_by_day = {}
+    for dream in os.listdir(dreams_folder_path):
         date = dream[2:len("d-YYYY-MM-dd")]
 
-        for day in days:
-            if day.startswith(date):
-                day_dir = os.path.join(days_folder_path, day)
-                embed_dream(day_dir, dream)
+        if since is not None and date < since:
+            continue
+
+        if date in days:
+            dreams_by_day.setdefault(days[date], []).append(dream)
 
-                break
+    for day, dreams in dreams_by_day.items():
+        day_dir = os.path.join(days_folder_path, day)
+        embed_dream(day_dir, *dreams)
 
     print("done!")
 
-def embed_dream(day_dir: str, dream_filename: str):
-    dream_link = link(dream_filename)
-    new_lines = []
+def embed_dream(day_dir: str, *dream_filenames: str):
+    # all dreams of a day are added at once, last one first,
+    # same as if they were added one at a time
 
     with open(day_dir, "r", encoding="utf-8") as file:
-        text = file.read()
-        if dream_filename[:-3] in text:
-            return
+        lines = file.readlines()
 
-    with open(day_dir, "r", encoding="utf-8") as file:
-        dream_added = False
+    document = parse_document(lines)
 
-        for line in file.readlines():
-            line_stripped = line.strip()
+    # first line of content, after the frontmatter and any "-" lists, headings and tags
+    i = next((i for block_kind, start, end in document.blocks if block_kind != BlockKind.FRONTMATTER
+        for i in range(start, end) if lines[i].strip()[:1] not in ["", "-", "#"]), None)
 
-            # first paragraph
-            if not dream_added and len(line_stripped) > 0 and line_stripped[0] not in ["-", "#"]:
-                new_lines.append(dream_link)
-                new_lines.append("\n\n")
-                new_lines.append(line)
+    if i is None:
+        return
 
-                dream_added = True
-                continue
-            else:
-                new_lines.append(line)
+    text = "".join(lines)
+    dream_links = []
+
+    for dream_filename in dream_filenames:
+        name = dream_filename[:-3]
+
+        # already embedded, possibly by this run
+        if name in text or any(name in dream_link for dream_link in dream_links):
+            continue
+
+        dream_links.insert(0, link(dream_filename))
+
+    if not dream_links:
+        return
+
+    new_lines = lines[:i]
+    for dream_link in dream_links:
+        new_lines.append(dream_link)
+        new_lines.append("\n\n")
+    new_lines += lines[i:]
 
     write_lines(new_lines, day_dir)
 
@@ -426,8 +1939,55 @@ REPLACE_CHARS_RULES = [
     ["’", "'"],
     #["—", "–"],
     ["	", "  "]]
+# None means one worker per core
+WORKERS = None
+# number of files sent to a worker at a time
+BATCH_SIZE = 32
+# lines longer than this aren't cached by classify_line
+CLASSIFY_CACHE_MAX_LEN = 200
+# "none", "file" or "run"; see Writer
+FSYNC = "none"
+# write files on a separate thread while the next ones are formatted
+BACKGROUND_WRITES = True
+# formatted files waiting to be written
+WRITE_QUEUE_SIZE = 64
+# seconds to wait after a save before formatting, in case more follow
+WATCH_DEBOUNCE = 0.05
+# seconds between scans when watching without watchdog
+WATCH_POLL_INTERVAL = 1.0
+# parsed notes kept by parse_document
+DOCUMENT_CACHE_SIZE = 64
+# bytes; larger files are formatted line by line instead of being read at once
+STREAM_THRESHOLD = 16 * 1024 * 1024
+# slowest files listed by --profile
+PROFILE_TOP_N = 10
+# skip files that haven't changed since the last run
+USE_CACHE = True
+CACHE_FILENAME = ".md_formatter_cache.json"
+# bump when the formatting itself changes, to invalidate old caches
+CACHE_VERSION = 1
+LINK_INDEX_FILENAME = ".md_formatter_links.json"
+# bump when find_links changes
+LINK_INDEX_VERSION = 1
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--check", action="store_true", help="don't write; exit with 1 if any file would change")
+    parser.add_argument("--diff", action="store_true", help="with --check, print what would change")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--fsync", choices=["none", "file", "run"], default=FSYNC)
+    parser.add_argument("--watch", action="store_true", help="keep formatting notes as they are saved")
+    parser.add_argument("--profile", action="store_true", help="print where the time goes")
+    parser.add_argument("--profile-json", metavar="PATH", help="with --profile, also save the report as json")
+    parser.add_argument("--pstats", metavar="PATH",
+        help="with --profile, also save a cProfile of this process; use --workers 1 to include formatting")
+    parser.add_argument("--trace", metavar="PATH", help="with --profile, also save a chrome trace")
+    parser.add_argument("--backlinks", metavar="NOTE", help="list the links to a note")
+    parser.add_argument("--rename-link", nargs=2, action="append", metavar=("OLD", "NEW"),
+        help="point the links to OLD to NEW instead; can be given several times")
+    args = parser.parse_args()
+
     print("\n-------")
     print("NEW RUN")
     print("-------\n")
@@ -438,7 +1998,45 @@ def main():
 
     ignore = ["00 meta", "utdrag"]
 
-    format(folder, ignore)
+    if args.watch:
+        watch(folder, ignore, args.workers, not args.no_cache, args.fsync)
+        return
+
+    if args.backlinks or args.rename_link:
+        index = LinkIndex(folder, ignore)
+        index.update()
+
+        if args.backlinks:
+            for key, i, column in index.backlinks(args.backlinks):
+                print(f"{key}:{i + 1}:{column + 1}")
+
+        if args.rename_link:
+            print(f"{index.rename_links(dict(args.rename_link))} links renamed")
+
+        index.save()
+        return
+
+    profile = Profile() if args.profile else None
+    profiler = cProfile.Profile() if args.profile and args.pstats else None
+
+    if profiler:
+        profiler.enable()
+
+    stats = format(folder, ignore, args.workers, USE_CACHE and not args.no_cache, args.check, args.diff, args.fsync,
+        profile)
+
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.pstats)
+
+    if profile and args.profile_json:
+        profile.save(args.profile_json)
+
+    if profile and args.trace:
+        profile.save_trace(args.trace)
+
+    if args.check and stats.files_changed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
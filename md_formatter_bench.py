@@ -0,0 +1,912 @@
+from collections.abc import Callable
+from contextlib import redirect_stdout
+import argparse
+import gc
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import md_formatter
+
+# benchmarks for md_formatter, on synthetic vaults.
+# notes are generated from a seed, so the same scale always gives the same vault,
+# and what every benchmark outputs is checked against the golden digests in GOLDEN_FILENAME.
+# timings can be saved as a baseline and compared against later.
+
+# generate
+
+WORDS = ["the", "a", "note", "day", "walk", "rain", "idea", "book", "wrote", "read", "met", "and",
+    "then", "later", "it’s", "“quoted”", "maybe…", "garden", "train", "coffee", "letter", "slowly"]
+
+def generate_sentence(rng: random.Random) -> str:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(4, 14))]
+    return " ".join(words).capitalize() + "."
+
+def generate_note(rng: random.Random, scale: dict) -> str:
+    lines = []
+
+    if rng.random() < scale["frontmatter"]:
+        lines += ["---", f"tags: {rng.choice(WORDS)}", f"date: 2020-01-{rng.randint(1, 28):02}", "---"]
+
+    lines.append(f"# {generate_sentence(rng)}")
+
+    for _ in range(rng.randint(1, scale["blocks"])):
+        # notes that haven't been formatted yet: missing and double blanklines,
+        # trailing whitespace, tabs and paragraphs split over lines
+        lines += [""] * rng.choice([0, 1, 1, 2])
+        r = rng.random()
+
+        if r < scale["lists"]:
+            for _ in range(rng.randint(1, 8)):
+                lines.append(rng.choice(["- ", "* ", "- [ ] ", "1. ", "\t- "]) + generate_sentence(rng))
+
+        elif r < scale["lists"] + scale["tables"]:
+            lines.append("| " + " | ".join(rng.choice(WORDS) for _ in range(3)) + " |")
+            lines.append("|---|---|---|")
+            for _ in range(rng.randint(1, 6)):
+                lines.append("| " + " | ".join(rng.choice(WORDS) for _ in range(3)) + " |")
+
+        elif r < scale["lists"] + scale["tables"] + scale["code"]:
+            lines.append("```python")
+            for _ in range(rng.randint(1, 10)):
+                lines.append("    " * rng.randint(0, 2) + f"x = {rng.randint(0, 99)}  ")
+            lines.append("```")
+
+        elif r < 0.9:
+            for _ in range(rng.randint(1, scale["paragraph"])):
+                line = generate_sentence(rng)
+                if rng.random() < scale["links"]:
+                    line += f" [[{rng.choice(WORDS)}|{rng.choice(WORDS)}]] and [[n{rng.randint(0, 99)}]]"
+                lines.append(line + rng.choice(["", "", " ", "  "]))
+
+        else:
+            lines.append(rng.choice(["## ", "> ", "[^1]: ", "key:: "]) + generate_sentence(rng))
+
+    return "\n".join(lines) + "\n"
+
+def generate_vault(folder_path: str, scale: dict, seed: int = 0):
+    rng = random.Random(seed)
+
+    for i in range(scale["files"]):
+        folder = os.path.join(folder_path, *[f"d{rng.randrange(4)}" for _ in range(rng.randrange(scale["depth"] + 1))])
+        os.makedirs(folder, exist_ok=True)
+
+        with open(os.path.join(folder, f"n{i}.md"), "w", encoding="utf-8", newline="") as file:
+            file.write(generate_note(rng, scale))
+
+def generate_large_note(dir_: str, size: int, scale: dict, seed: int = 0):
+    # one note of at least size bytes, made of generated notes one after the other
+    rng = random.Random(seed)
+    written = 0
+
+    with open(dir_, "w", encoding="utf-8", newline="") as file:
+        while written < size:
+            written += file.write(generate_note(rng, scale) + "\n")
+
+def generate_wrapped_note(rng: random.Random, n_lines: int) -> list[str]:
+    # a heading and one paragraph soft wrapped over n_lines lines, as read and trimmed
+    return [f"# {generate_sentence(rng)}\n", "\n"] + [generate_sentence(rng) + "\n" for _ in range(n_lines)]
+
+def generate_lines(rng: random.Random, n_lines: int, scale: dict) -> list[str]:
+    # lines of generated notes, as read, and one in five made of the characters the
+    # predicates look at, to reach the corners of classify_line
+    lines = []
+
+    while len(lines) < n_lines:
+        for line in generate_note(rng, scale).splitlines(keepends=True):
+            lines.append(line)
+            if rng.random() < 0.25:
+                lines.append("".join(rng.choice("-*+#>`[^]:|.) 019\\\tx") for _ in range(rng.randint(0, 8)))
+                    + rng.choice(["\n", "\n", "\r\n", ""]))
+
+    return lines[:n_lines]
+
+def generate_tree(folder_path: str, n_files: int, seed: int = 0):
+    # a deep, wide tree of small notes, with some hidden and non-md files and ignored folders,
+    # for timing the walk rather than formatting
+    # skipped folders are leaves, so that most of the tree is still walked
+    rng = random.Random(seed)
+    folders = [folder_path]
+    skipped = []
+    os.makedirs(folder_path, exist_ok=True)
+
+    for i in range(n_files):
+        if rng.random() < 0.05:
+            folder = os.path.join(rng.choice(folders[-50:]), f"d{i}")
+            os.makedirs(folder)
+            folders.append(folder)
+        elif rng.random() < 0.002:
+            folder = os.path.join(rng.choice(folders), rng.choice([".hidden", "node_modules"]))
+            os.makedirs(folder, exist_ok=True)
+            skipped.append(folder)
+
+        folder = rng.choice(skipped) if skipped and rng.random() < 0.02 else rng.choice(folders)
+        name = f"n{i}" + rng.choice([".md", ".md", ".md", ".md", ".png", ".txt"])
+        with open(os.path.join(folder, name), "w", encoding="utf-8") as file:
+            file.write("# note\n")
+
+def generate_gdoc(rng: random.Random, n_comments: int) -> str:
+    # a google docs export: tagged text, then the comments at the bottom
+    tags = [chr(ord("a") + k) if k < 26 else chr(ord("a") + k // 26 - 1) + chr(ord("a") + k % 26)
+        for k in range(n_comments)]
+
+    text = []
+    for tag in tags:
+        text.append(" ".join(generate_sentence(rng) for _ in range(rng.randint(1, 4))) + f"[{tag}]")
+        text.append("")
+
+    for tag in tags:
+        text.append(f"[{tag}]{generate_sentence(rng)}")
+
+    return "\n".join(text) + "\n"
+
+def read_notes(folder_path: str) -> list[list[str]]:
+    notes = []
+
+    for dir_, message in md_formatter.walk(folder_path, []):
+        if message is None:
+            with open(dir_, "r", encoding="utf-8") as file:
+                notes.append(file.readlines())
+
+    return notes
+
+# benchmarks
+
+def digest_lines(outputs: list[list[str]]) -> str:
+    sha1 = hashlib.sha1()
+    for lines in outputs:
+        sha1.update("".join(lines).encode("utf-8"))
+        sha1.update(b"\0")
+    return sha1.hexdigest()
+
+def digest_folder(folder_path: str) -> str:
+    sha1 = hashlib.sha1()
+
+    for dir_, message in md_formatter.walk(folder_path, []):
+        if message is None:
+            sha1.update(os.path.relpath(dir_, folder_path).replace(os.sep, "/").encode("utf-8"))
+            with open(dir_, "rb") as file:
+                sha1.update(file.read())
+
+    return sha1.hexdigest()
+
+def best_of(repeat: int, do: Callable[[], object], before: Callable[[], None] = None):
+    # (fastest seconds, what do returned the last time).
+    # the garbage collector is off while timing, like in timeit
+    best = None
+    result = None
+
+    for _ in range(repeat):
+        if before is not None:
+            before()
+
+        result = None
+        gc.collect()
+        gc.disable()
+
+        try:
+            start = time.perf_counter()
+            result = do()
+            seconds = time.perf_counter() - start
+        finally:
+            gc.enable()
+
+        best = seconds if best is None else min(best, seconds)
+
+    return best, result
+
+def walk_listdir(folder_path: str, ignore_folders: list[str]):
+    # the walker on_all had before walk: a recursive listdir that told folders from files by
+    # failing to open them. windows raises PermissionError for a folder, linux IsADirectoryError
+    for filename in os.listdir(folder_path):
+        dir_ = os.path.join(folder_path, filename)
+
+        if filename[0] == ".":
+            continue
+
+        dotindex = filename.rfind(".")
+        if dotindex != -1 and filename[dotindex + 1:] != "md":
+            continue
+
+        try:
+            with open(dir_, "r", encoding="utf-8"):
+                yield dir_
+        except (PermissionError, IsADirectoryError):
+            if filename not in ignore_folders:
+                yield from walk_listdir(dir_, ignore_folders)
+
+def bench_walk(folder_path: str, repeat: int) -> dict:
+    # walk against the walker it replaced. the digest is of the notes found, which both should agree on
+    ignore_folders = ["node_modules"]
+    results = {}
+
+    walkers = {
+        "walk": lambda: [dir_ for dir_, message in md_formatter.walk(folder_path, ignore_folders) if message is None],
+        "walk_listdir": lambda: list(walk_listdir(folder_path, ignore_folders))}
+
+    for name, walker in walkers.items():
+        seconds, dirs = best_of(repeat, walker)
+        found = sorted(os.path.relpath(dir_, folder_path).replace(os.sep, "/") for dir_ in dirs)
+        results[name] = {
+            "seconds": seconds,
+            "files": len(found),
+            "digest": hashlib.sha1("\n".join(found).encode("utf-8")).hexdigest()}
+
+    return results
+
+def format_blanklines_concat(lines: list[str]) -> list[str]:
+    # format_blanklines before it was a single pass, which merged a paragraph by concatenating
+    # one line at a time. lines[i + 1] is corrected to lines[j], so that it can be compared
+    from md_formatter import is_p, is_nl, is_li, is_blockquote, is_tr, is_footnote, is_forcing_nl
+
+    lines = lines + ["\n"]
+    new_lines = []
+
+    is_first_text_found = False
+    is_in_frontmatter = False
+    is_in_code_block = False
+    line_next_already_added = 0
+
+    for i in range(len(lines) - 1):
+        if line_next_already_added > 0:
+            line_next_already_added -= 1
+            continue
+
+        line = lines[i]
+        line_next = lines[i + 1]
+
+        if not is_first_text_found:
+            if line == "\n":
+                continue
+            else:
+                is_first_text_found = True
+
+                if line.strip() == "---":
+                    is_in_frontmatter = True
+                    new_lines.append(line)
+                    continue
+
+        if is_in_frontmatter:
+            if line.strip() == "---":
+                is_in_frontmatter = False
+            new_lines.append(line)
+            continue
+
+        if line.strip()[:3] == "```":
+            is_in_code_block = not is_in_code_block
+            new_lines.append(line)
+            continue
+        if is_in_code_block or (len(line) > 4 and line[:4] == "    "):
+            new_lines.append(line)
+            continue
+
+        if is_tr(line):
+            new_lines.append(line)
+            continue
+
+        if is_p(line) and not is_forcing_nl(line):
+            line_concat = line
+            n_merged = 0
+
+            for j in range(i + 1, len(lines) - 1):
+                if is_p(lines[j]):
+                    line_concat = line_concat.rstrip() + " " + lines[j].lstrip()
+                    n_merged += 1
+                else:
+                    break
+
+            line = line_concat
+            line_next = lines[i + 1 + n_merged]
+            line_next_already_added += n_merged
+
+        if not (is_nl(line) and is_nl(line_next)):
+            new_lines.append(line)
+
+        if (
+            len(line) >= 1
+            and not is_nl(line) and not is_nl(line_next)
+            and not is_li(line) and not is_blockquote(line)
+            and not is_forcing_nl(line)
+            and not (is_footnote(line) and is_li(line_next))):
+
+            new_lines.append("\n")
+
+    if len(lines) > 0 and lines[-1] != "\n":
+        new_lines.append(lines[-1].rstrip() + "\n")
+
+    return new_lines
+
+def bench_blanklines(n_lines: int, repeat: int, seed: int = 0) -> dict:
+    # format_blanklines against the merge it replaced, on one long soft wrapped paragraph
+    lines = generate_wrapped_note(random.Random(seed), n_lines)
+    results = {}
+
+    for do in [md_formatter.format_blanklines, format_blanklines_concat]:
+        def run():
+            md_formatter.document_cache.clear()
+            return do(list(lines))
+
+        seconds, new_lines = best_of(repeat, run)
+        results[do.__name__] = {
+            "seconds": seconds,
+            "us_per_line": seconds / n_lines * 1e6,
+            "digest": digest_lines([new_lines])}
+
+    return results
+
+def check_blanklines(notes: list[list[str]]) -> bool:
+    # whether format_blanklines and format_blanklines_concat agree on notes, once trimmed
+    for lines in notes:
+        lines = md_formatter.trim_trailing_whitespace(list(lines))
+        if md_formatter.format_blanklines(list(lines)) != format_blanklines_concat(lines):
+            return False
+
+    return True
+
+# the line predicates before classify_line, for bench_predicates
+
+def is_p_old(line: str):
+    return (
+        len(line) >= 1 and not line[0] == " " and not md_formatter.is_nl(line)
+        and not is_h_old(line)
+        and not is_li_old(line)
+        and not is_blockquote_old(line)
+        and not is_codeblock_fence_old(line)
+        and not is_tr_old(line)
+        and not is_footnote_old(line)
+        and not is_dv_inline_field_old(line))
+
+def is_ul_li_old(line: str):
+    line = line.strip()
+    return len(line) >= 1 and line[0] in ["-", "*", "+"] and (len(line) == 1 or line[1] == " ")
+
+def is_ul_cb_old(line: str):
+    line = line.strip()
+    return (len(line) >= 5
+        and line[0] in ["-", "*", "+"]
+        and line[1] == " "
+        and line[2] == "["
+        and line[4] == "]"
+        and (len(line) == 5 or line[5] == " "))
+
+def is_ol_li_old(line: str):
+    line = line.strip().replace(")", ".")
+
+    dotindex = line.find(".")
+
+    if dotindex not in [-1, 0]:
+        potential_number = line[:dotindex]
+        for c in potential_number:
+            if c not in md_formatter.numbers:
+                return False
+
+        return len(line) == dotindex + 1 or line[dotindex + 1] == " "
+
+    return False
+
+def is_li_old(line: str):
+    return is_ul_li_old(line) or is_ol_li_old(line) or is_dv_inline_field_old(line)
+
+def is_blockquote_old(line: str):
+    line = line.strip()
+    return len(line) >= 1 and line[0] == ">" and (len(line) == 1 or line[1] == " ")
+
+def is_codeblock_fence_old(line: str):
+    return len(line) >= 3 and line.strip()[:3] == "```"
+
+def is_h_old(line: str):
+    for level in range(1, 7):
+        if line.startswith(md_formatter.h(level)):
+            return True
+
+    return False
+
+def is_tr_old(line: str):
+    return len(line) >= 1 and line[0] == "|"
+
+def is_footnote_old(line: str):
+    line = line.strip()
+    return len(line) >= 5 and line[0:2] == "[^" and "]:" in line
+
+def is_forcing_nl_old(line: str):
+    # raised IndexError on whitespace-only lines, which is_forcing_nl now says aren't forcing
+    try:
+        return len(line) >= 1 and line.strip()[-1] == "\\"
+    except IndexError:
+        return False
+
+def is_dv_inline_field_old(line: str):
+    line = line.strip()
+    return line.find("::") > 0
+
+def classify_line_old(line: str) -> int:
+    # what classify_line returns, from the old predicates
+    kind = 0
+
+    for flag, is_ in [
+        (md_formatter.LineKind.NL, md_formatter.is_nl),
+        (md_formatter.LineKind.H, is_h_old),
+        (md_formatter.LineKind.UL_LI, is_ul_li_old),
+        (md_formatter.LineKind.UL_CB, is_ul_cb_old),
+        (md_formatter.LineKind.OL_LI, is_ol_li_old),
+        (md_formatter.LineKind.DV_INLINE_FIELD, is_dv_inline_field_old),
+        (md_formatter.LineKind.BLOCKQUOTE, is_blockquote_old),
+        (md_formatter.LineKind.CODEBLOCK_FENCE, is_codeblock_fence_old),
+        (md_formatter.LineKind.TR, is_tr_old),
+        (md_formatter.LineKind.FOOTNOTE, is_footnote_old),
+        (md_formatter.LineKind.FORCING_NL, is_forcing_nl_old),
+        (md_formatter.LineKind.P, is_p_old)]:
+
+        if is_(line):
+            kind |= flag
+
+    return kind
+
+def bench_predicates(n_lines: int, repeat: int, seed: int = 0) -> dict:
+    # the predicates format_blanklines leans on most, and a whole classification, against the
+    # old ones. cold clears classify_line's cache before every run, warm fills it first.
+    # n_lines is kept under the cache's size, so that warm is all hits
+    lines = generate_lines(random.Random(seed), n_lines, SCALES["medium"])
+    cache_clear = md_formatter.classify_line_cached.cache_clear
+
+    predicates = [
+        (md_formatter.is_p, is_p_old),
+        (md_formatter.is_h, is_h_old),
+        (md_formatter.is_li, is_li_old),
+        (md_formatter.classify_line, classify_line_old)]
+
+    results = {}
+
+    for is_, is_old in predicates:
+        def run(is_=is_):
+            return [is_(line) for line in lines]
+
+        def fill(is_=is_):
+            cache_clear()
+            run(is_)
+
+        for name, do, before in [
+            (is_.__name__ + "_cold", run, cache_clear),
+            (is_.__name__ + "_warm", run, fill),
+            (is_old.__name__, lambda is_old=is_old: [is_old(line) for line in lines], None)]:
+
+            seconds, outputs = best_of(repeat, do, before)
+            results[name] = {
+                "seconds": seconds,
+                "us_per_line": seconds / n_lines * 1e6,
+                "digest": hashlib.sha1(repr([int(output) for output in outputs]).encode("utf-8")).hexdigest()}
+
+    cache_clear()
+    return results
+
+def check_predicates(lines: list[str]) -> list[str]:
+    # names of the predicates that don't say what the old ones did about some line
+    cache_clear = md_formatter.classify_line_cached.cache_clear
+    mismatches = []
+
+    for name in ["is_p", "is_ul_li", "is_ul_cb", "is_ol_li", "is_li", "is_blockquote", "is_codeblock_fence",
+        "is_h", "is_tr", "is_footnote", "is_forcing_nl", "is_dv_inline_field", "classify_line"]:
+
+        is_ = getattr(md_formatter, name)
+        is_old = globals()[name + "_old"]
+
+        # cold and warm
+        for _ in range(2):
+            if any(is_(line) != is_old(line) for line in lines):
+                mismatches.append(name)
+                break
+        cache_clear()
+
+    return mismatches
+
+def bench_transforms(notes: list[list[str]], repeat: int) -> dict:
+    # every public transform on every note, as lists of lines
+    n_lines = sum(len(lines) for lines in notes)
+    transforms = [
+        md_formatter.replace_chars,
+        md_formatter.trim_trailing_whitespace,
+        md_formatter.format_blanklines,
+        md_formatter.format_lines,
+        md_formatter.remove_links_lines]
+
+    results = {}
+
+    for do in transforms:
+        def run():
+            # parse_document would otherwise remember the notes from the last repeat
+            md_formatter.document_cache.clear()
+            return [do(list(lines)) for lines in notes]
+
+        seconds, outputs = best_of(repeat, run)
+        results[do.__name__] = {
+            "seconds": seconds,
+            "us_per_line": seconds / max(n_lines, 1) * 1e6,
+            "digest": digest_lines(outputs)}
+
+    return results
+
+def check_fused(notes: list[list[str]]) -> list[str]:
+    # names of the fused transforms whose output or stats differ from running
+    # replace_chars, trim_trailing_whitespace and format_blanklines one after the other
+    fused = {
+        "format_lines": md_formatter.format_lines,
+        "format_lines_iter": lambda lines, stats: list(md_formatter.format_lines_iter(iter(lines), stats))}
+
+    mismatches = set()
+
+    for lines in notes + EDGE_NOTES:
+        expected_stats = md_formatter.FormatStats()
+        expected = md_formatter.format_blanklines(
+            md_formatter.trim_trailing_whitespace(
+                md_formatter.replace_chars(list(lines), expected_stats), expected_stats), expected_stats)
+
+        for name, do in fused.items():
+            stats = md_formatter.FormatStats()
+            if do(list(lines), stats) != expected or vars(stats) != vars(expected_stats):
+                mismatches.add(name)
+
+    return sorted(mismatches)
+
+def measure_format_file(dir_: str) -> dict:
+    # the memory format_file peaks at on one large note, streamed and read whole.
+    # the whole note's formatted lines are returned, as they are to on_all, so they count too
+    stream_threshold = md_formatter.STREAM_THRESHOLD
+    results = {}
+
+    try:
+        for name, threshold in [("whole", float("inf")), ("streamed", 0)]:
+            md_formatter.STREAM_THRESHOLD = threshold
+            md_formatter.document_cache.clear()
+            gc.collect()
+
+            tracemalloc.start()
+            result = md_formatter.format_file((dir_, None, None), [md_formatter.format_lines])
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            _, message, new_lines, digest, stats, stat = result
+            if isinstance(new_lines, str):
+                os.remove(new_lines)
+
+            results[name] = {"bytes": os.path.getsize(dir_), "peak_bytes": peak, "digest": digest}
+            del result, new_lines
+    finally:
+        md_formatter.STREAM_THRESHOLD = stream_threshold
+
+    return results
+
+def bench_gdoc(scale: dict, repeat: int, seed: int = 0) -> dict:
+    text = generate_gdoc(random.Random(seed), scale["comments"])
+
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        seconds, new_text = best_of(repeat, lambda: md_formatter.embed_comments(text))
+
+    return {"seconds": seconds, "digest": hashlib.sha1(new_text.encode("utf-8")).hexdigest()}
+
+def embed_gdoc_comments_reread(path: str, filename: str):
+    # embed_gdoc_comments before embed_comments: every tag from [zz] down to [a] re-reads
+    # the whole export, and every tag found rewrites it
+    dir_ = path + filename
+
+    letters0 = list("abcdefghijklmnopqrstuvwxyz")
+    letters0.insert(0,"")
+    n = 26
+
+    for i in reversed(range(n ** 2 + n)):
+        c0 = letters0[i // n]
+        c1 = md_formatter.letters[i % n]
+        tag = "[" + c0 + c1 + "]"
+
+        new_text = ""
+
+        with open(dir_, "r", encoding="utf-8") as file:
+            text = file.read()
+            l_index = text.find(tag)
+            r_index = text.rfind(tag)
+
+            if l_index == -1 or r_index == -1:
+                continue
+
+            new_text = text[:l_index] + text[l_index + len(tag):]
+
+            bl_index = len(text) - 1
+
+            for char_index in range(l_index + len(tag), len(text)):
+                if text[char_index:char_index + 2] == "\n\n":
+                    bl_index = char_index
+                    break
+
+            bl_index = bl_index - len(tag)
+
+            comment = text[r_index + len(tag):]
+
+            new_text = new_text[:r_index - len(tag)]
+            new_text = new_text[:bl_index + 2] + comment + new_text[bl_index + 2:]
+
+        with open(dir_, "w", encoding="utf-8") as file:
+            file.write(new_text)
+
+def bench_gdoc_file(folder_path: str, n_comments: int, repeat: int, seed: int = 0) -> dict:
+    # embed_gdoc_comments against the loop it replaced, on an export written to folder_path.
+    # the export is written again before every run, since both change it in place
+    text = generate_gdoc(random.Random(seed), n_comments)
+    dir_ = os.path.join(folder_path, "gdoc.md")
+    results = {}
+
+    def restore():
+        with open(dir_, "w", encoding="utf-8", newline="") as file:
+            file.write(text)
+
+    def read():
+        with open(dir_, "r", encoding="utf-8", newline="") as file:
+            return file.read()
+
+    for do in [md_formatter.embed_gdoc_comments, embed_gdoc_comments_reread]:
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            seconds, _ = best_of(repeat, lambda: do(folder_path + os.sep, "gdoc.md"), restore)
+
+        results[do.__name__] = {
+            "seconds": seconds,
+            "bytes": len(text.encode("utf-8")),
+            "digest": hashlib.sha1(read().encode("utf-8")).hexdigest()}
+
+    return results
+
+def bench_format(folder_path: str, repeat: int, workers: int = None) -> dict:
+    # format on a fresh copy of the vault every time, without the cache
+    run_folder_path = folder_path + "-run"
+
+    def copy():
+        shutil.rmtree(run_folder_path, ignore_errors=True)
+        shutil.copytree(folder_path, run_folder_path)
+
+    def run():
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            return md_formatter.format(run_folder_path, [], workers, use_cache=False)
+
+    seconds, stats = best_of(repeat, run, copy)
+
+    return {
+        "seconds": seconds,
+        "files_changed": stats.files_changed,
+        "digest": digest_folder(run_folder_path)}
+
+def bench(scale_names: list[str], repeat: int, workers: int = None, walk_files: int = 0,
+    blanklines_lines: int = 0, predicate_lines: int = 0, gdoc_comments: int = 0, mismatches: list[str] = None) -> dict:
+    # mismatches gets what differs from what it should match: the fused transforms from the
+    # separate ones, and format_blanklines, the predicates and embed_gdoc_comments from what they replaced
+    results = {}
+    mismatches = [] if mismatches is None else mismatches
+
+    with tempfile.TemporaryDirectory() as tmp_folder_path:
+        if walk_files:
+            print(f"walk: {walk_files} files ...")
+
+            folder_path = os.path.join(tmp_folder_path, "tree")
+            generate_tree(folder_path, walk_files)
+            results[f"walk_{walk_files}"] = bench_walk(folder_path, repeat)
+
+        if predicate_lines:
+            print(f"predicates: {predicate_lines} lines ...")
+
+            name = f"predicates_{predicate_lines}"
+            results[name] = bench_predicates(predicate_lines, repeat)
+            lines = generate_lines(random.Random(1), predicate_lines * 2, SCALES["large"]) + EDGE_LINES
+            mismatches += [f"{name}/{is_} doesn't match {is_}_old" for is_ in check_predicates(lines)]
+            mismatches += [f"{name}/{is_} doesn't match {is_}_old" for is_ in ["is_p", "is_h", "is_li", "classify_line"]
+                if len({results[name][suffixed]["digest"] for suffixed in [is_ + "_cold", is_ + "_warm", is_ + "_old"]}) != 1]
+
+        if gdoc_comments:
+            print(f"gdoc: {gdoc_comments} comments ...")
+
+            name = f"gdoc_{gdoc_comments}"
+            folder_path = os.path.join(tmp_folder_path, "gdoc")
+            os.makedirs(folder_path)
+            results[name] = bench_gdoc_file(folder_path, gdoc_comments, repeat)
+            if results[name]["embed_gdoc_comments"]["digest"] != results[name]["embed_gdoc_comments_reread"]["digest"]:
+                mismatches.append(f"{name}/embed_gdoc_comments doesn't match embed_gdoc_comments_reread")
+
+        if blanklines_lines:
+            print(f"blanklines: {blanklines_lines} lines ...")
+
+            name = f"blanklines_{blanklines_lines}"
+            results[name] = bench_blanklines(blanklines_lines, repeat)
+            if results[name]["format_blanklines"]["digest"] != results[name]["format_blanklines_concat"]["digest"]:
+                mismatches.append(f"{name}/format_blanklines doesn't match format_blanklines_concat")
+
+        for scale_name in scale_names:
+            scale = SCALES[scale_name]
+            print(f"{scale_name}: {scale['files']} files ...")
+
+            folder_path = os.path.join(tmp_folder_path, scale_name)
+            generate_vault(folder_path, scale)
+            notes = read_notes(folder_path)
+            mismatches += [f"{scale_name}/{name} doesn't match replace_chars, trim_trailing_whitespace and format_blanklines"
+                for name in check_fused(notes)]
+            if not check_blanklines(notes):
+                mismatches.append(f"{scale_name}/format_blanklines doesn't match format_blanklines_concat")
+
+            results[scale_name] = {
+                **bench_transforms(notes, repeat),
+                "embed_comments": bench_gdoc(scale, repeat),
+                "format": bench_format(folder_path, repeat, workers)}
+
+    return results
+
+def check_golden(results: dict, golden: dict) -> list[str]:
+    # names of the benchmarks whose output isn't what it was when golden was saved
+    mismatches = []
+
+    for scale_name, benchmarks in results.items():
+        for name, result in benchmarks.items():
+            expected = golden.get(scale_name, {}).get(name)
+            if expected is not None and expected != result["digest"]:
+                mismatches.append(f"{scale_name}/{name}")
+
+    return mismatches
+
+def compare(results: dict, baseline: dict, threshold: float = 0.1) -> list[str]:
+    # prints the time of every benchmark against the baseline.
+    # returns the names of those slower by more than threshold, as a share of the baseline
+    regressions = []
+
+    for scale_name, benchmarks in results.items():
+        for name, result in benchmarks.items():
+            before = baseline.get(scale_name, {}).get(name)
+            if before is None:
+                continue
+
+            ratio = result["seconds"] / before["seconds"] if before["seconds"] else 1.0
+            is_regression = ratio > 1 + threshold
+
+            print(f"{scale_name + '/' + name:<44} {before['seconds']:8.4f} s -> {result['seconds']:8.4f} s"
+                + f"  {ratio:5.2f}x{'  slower' if is_regression else ''}")
+
+            if is_regression:
+                regressions.append(f"{scale_name}/{name}")
+
+    return regressions
+
+def print_results(results: dict):
+    for scale_name, benchmarks in results.items():
+        for name, result in benchmarks.items():
+            line = f"{scale_name + '/' + name:<44} {result['seconds']:8.4f} s"
+            if "us_per_line" in result:
+                line += f"  {result['us_per_line']:6.2f} us/line"
+            print(line)
+
+# main
+
+# files: notes in the vault; depth: of folders; blocks: per note, at most; paragraph: lines per paragraph,
+# at most; lists, tables, code: share of blocks; links: share of paragraph lines with links;
+# frontmatter: share of notes; comments: in the google docs export
+SCALES = {
+    "small": {"files": 100, "depth": 1, "blocks": 20, "paragraph": 4, "lists": 0.2, "tables": 0.05,
+        "code": 0.05, "links": 0.2, "frontmatter": 0.3, "comments": 30},
+    "medium": {"files": 1000, "depth": 2, "blocks": 30, "paragraph": 6, "lists": 0.2, "tables": 0.05,
+        "code": 0.1, "links": 0.2, "frontmatter": 0.3, "comments": 200},
+    "large": {"files": 5000, "depth": 3, "blocks": 40, "paragraph": 8, "lists": 0.25, "tables": 0.1,
+        "code": 0.1, "links": 0.3, "frontmatter": 0.5, "comments": 600}}
+# notes the generator doesn't make, for check_fused
+EDGE_NOTES = [
+    [],
+    ["\n"],
+    ["\n", "\n", "  \n"],
+    ["no newline at the end"],
+    ["“quoted”\t \n", "\n", "\n", "- item\n", "text\n"],
+    ["---\n", "a: 1\n", "---\n", "\n", "\n", "# heading\n", "text  \n", "more\n"],
+    ["```\n", "  code  \n", "\n", "\n", "```\n", "| a |\n", "|---|\n", "\n", "\n"],
+    ["- \n", "-  \n", "\n", "1. one\n", "   \n", "2. two"]]
+# lines check_predicates is run on besides generated ones
+EDGE_LINES = ["", "\n", "\r\n", "  \n", " ", "\t\n", "-", "- ", "-\n", "--", "- [ ]", "- [x] done\n", "- [ ]x",
+    "* item", "+ item", "\t- nested\n", "1.", "1)", "12. twelve", "1.5 apples", "a. b", ". x", "1.x", ">", "> quote",
+    ">no", "```", "```python\n", "``", "[^1]: note", "[^1]", "[^]:", "key:: value", "::value", "a::", "#", "# h",
+    "#tag", "###### six", "####### seven", "| a | b |", "|", "text \\\n", "\\", "    code\n", " lead"]
+# size of the note measure_format_file is run on
+MEMORY_NOTE_SIZE = 64 * 1024 * 1024
+# files in the tree walk is timed on
+WALK_FILES = 50_000
+# lines in the paragraph format_blanklines is timed on against the merge it replaced
+BLANKLINES_LINES = 10_000
+# lines the predicates are timed on; under the size of classify_line's cache
+PREDICATE_LINES = 10_000
+# comments in the export embed_gdoc_comments is timed on against the loop it replaced
+GDOC_COMMENTS = 300
+REPEAT = 3
+# how much slower than the baseline counts as a regression
+REGRESSION_THRESHOLD = 0.1
+GOLDEN_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "md_formatter_bench.json")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", nargs="+", choices=list(SCALES), default=list(SCALES))
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="time each benchmark this many times and keep the best")
+    parser.add_argument("--workers", type=int, default=md_formatter.WORKERS)
+    parser.add_argument("--walk-files", type=int, default=WALK_FILES, help="files in the tree to time walk on; 0 to skip")
+    parser.add_argument("--blanklines-lines", type=int, default=BLANKLINES_LINES,
+        help="lines in the paragraph to time format_blanklines on; 0 to skip")
+    parser.add_argument("--predicate-lines", type=int, default=PREDICATE_LINES,
+        help="lines to time the line predicates on; 0 to skip")
+    parser.add_argument("--gdoc-comments", type=int, default=GDOC_COMMENTS,
+        help="comments in the export to time embed_gdoc_comments on; 0 to skip")
+    parser.add_argument("--memory", action="store_true",
+        help="also measure the memory format_file peaks at on a large note, streamed and whole, with tracemalloc")
+    parser.add_argument("--update-golden", action="store_true", help="save what the benchmarks output as golden")
+    parser.add_argument("--save", metavar="PATH", help="save the results, to compare against later")
+    parser.add_argument("--compare", metavar="PATH", help="compare against results saved with --save")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+        help="how much slower than the baseline counts as a regression")
+    args = parser.parse_args()
+
+    output_mismatches = []
+    results = bench(args.scales, args.repeat, args.workers, args.walk_files, args.blanklines_lines,
+        args.predicate_lines, args.gdoc_comments, output_mismatches)
+
+    print("---")
+    print_results(results)
+
+    memory = None
+    if args.memory:
+        print("---")
+        with tempfile.TemporaryDirectory() as tmp_folder_path:
+            dir_ = os.path.join(tmp_folder_path, "large.md")
+            generate_large_note(dir_, MEMORY_NOTE_SIZE, SCALES["large"])
+            memory = measure_format_file(dir_)
+
+        for name, result in memory.items():
+            print(f"{'format_file/' + name:<44} {result['peak_bytes'] / 1e6:8.1f} MB peak traced"
+                + f"  ({result['bytes'] / 1e6:.1f} MB note)")
+
+    try:
+        with open(GOLDEN_FILENAME, "r", encoding="utf-8") as file:
+            golden = json.load(file)
+    except FileNotFoundError:
+        golden = {}
+
+    if args.update_golden:
+        for scale_name, benchmarks in results.items():
+            golden[scale_name] = {name: result["digest"] for name, result in benchmarks.items()}
+
+        with open(GOLDEN_FILENAME, "w", encoding="utf-8") as file:
+            json.dump(golden, file, indent=2)
+            file.write("\n")
+
+    mismatches = check_golden(results, golden)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+
+        print("---")
+        regressions = compare(results, baseline, args.threshold)
+
+    print("---")
+    for mismatch in mismatches:
+        print(f"{mismatch} doesn't match golden")
+    for regression in regressions:
+        print(f"{regression} is slower than the baseline")
+    for mismatch in output_mismatches:
+        print(mismatch)
+
+    streamed_mismatch = memory is not None and memory["whole"]["digest"] != memory["streamed"]["digest"]
+    if streamed_mismatch:
+        print("format_file streamed doesn't match format_file whole")
+
+    if mismatches or regressions or output_mismatches or streamed_mismatch:
+        sys.exit(1)
+
+    print("Done!")
+
+if __name__ == "__main__":
+    main()
@@ -1,117 +1,838 @@
+import argparse
+import collections
+import functools
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import pickle
+import re
+import sqlite3
+import sys
+import tempfile
+import time
 import xml.etree.ElementTree as ET
-import xml.dom.minidom as minidom
+from xml.sax.saxutils import escape
 
 # convert MMS to SMS, as exported by SMS Backup and Restore for Android.
 # the problem being solved is the fact that Google RCS messages were
 # exported as MMS, which Signal does not import.
 
 class Sms:
+    # an sms converted from an mms. there can be millions, so only what differs
+    # between them is stored, and the element is only built when asked for
+    __slots__ = ["address", "date", "type_", "body", "sub_id", "readable_date", "contact_name"]
+
+    tag = "sms"
+    protocol = "0"
+    subject = "null"
+    toa = "null"
+    sc_toa = "null"
+    service_center = "null"
+    read = "1"
+    status = "-1"
+    locked = "0"
+    date_sent = "0"
+
     def __init__(self, address, date, out, body, sub_id, readable_date, contact_name):
-        self.protocol = "0"
         self.address = address
         self.date = date
         self.type_ = "2" if out else "1"
-        self.subject = "null"
         self.body = body
-        self.toa = "null"
-        self.sc_toa = "null"
-        self.service_center = "null"
-        self.read = "1"
-        self.status = "-1"
-        self.locked = "0"
-        self.date_sent = "0"
         self.sub_id = sub_id
         self.readable_date = readable_date
         self.contact_name = contact_name
 
-        self.el = self.build_element()
-
     def __str__(self):
-        return str(self.el.attrib)
+        return str(self.attrib)
+
+    @property
+    def attrib(self):
+        # in the order of the attributes of an sms in a backup
+        return {
+            "protocol": self.protocol,
+            "address": self.address,
+            "date": self.date,
+            "type": self.type_,
+            "subject": self.subject,
+            "body": self.body,
+            "toa": self.toa,
+            "sc_toa": self.sc_toa,
+            "service_center": self.service_center,
+            "read": self.read,
+            "status": self.status,
+            "locked": self.locked,
+            "date_sent": self.date_sent,
+            "sub_id": self.sub_id,
+            "readable_date": self.readable_date,
+            "contact_name": self.contact_name,
+        }
 
     def build_element(self):
-        el = ET.Element("sms")
-        el.attrib["protocol"] = self.protocol
-        el.attrib["address"] = self.address
-        el.attrib["date"] = self.date
-        el.attrib["type"] = self.type_
-        el.attrib["subject"] = self.subject
-        el.attrib["body"] = self.body
-        el.attrib["toa"] = self.toa
-        el.attrib["sc_toa"] = self.sc_toa
-        el.attrib["service_center"] = self.service_center
-        el.attrib["read"] = self.read
-        el.attrib["status"] = self.status
-        el.attrib["locked"] = self.locked
-        el.attrib["date_sent"] = self.date_sent
-        el.attrib["sub_id"] = self.sub_id
-        el.attrib["readable_date"] = self.readable_date
-        el.attrib["contact_name"] = self.contact_name
-
-        return el
-
-def import_mms(root):
-    sms_text_existing = []
-    sms_existing = []
+        return ET.Element(self.tag, self.attrib)
+
+class Progress:
+    # how a conversion is going, printed every interval seconds while it runs and
+    # saved as json at the end. the clock is only read every PROGRESS_CHECK messages,
+    # so that counting costs next to nothing. with interval None, nothing is printed
+    def __init__(self, total_bytes=0, interval=None):
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.last_print = self.start
+
+        self.bytes_read = 0
+        self.messages = 0
+        self.sms = 0
+        self.mms_converted = 0
+        # mms without a text part
+        self.mms_empty = 0
+        # converted mms left out as duplicates of an sms
+        self.mms_duplicates = 0
+        # messages left out as copies of one from another backup, in batch mode
+        self.copies = 0
+        self.written = 0
+
+    def imported(self, message, imported):
+        # counts a message of a backup, and what import_message made of it
+        self.messages += 1
+
+        if message.tag == "sms":
+            self.sms += 1
+        elif imported is None:
+            self.mms_empty += 1
+        else:
+            self.mms_converted += 1
+
+        if self.messages % PROGRESS_CHECK == 0:
+            self.check()
+
+    def check(self):
+        if self.interval is None:
+            return
+
+        now = time.perf_counter()
+
+        if now - self.last_print >= self.interval:
+            self.last_print = now
+            # over the last line in a terminal
+            print(self, end="\r" if sys.stdout.isatty() else "\n", flush=True)
+
+    def counts(self):
+        return {
+            "bytes_read": self.bytes_read,
+            "messages": self.messages,
+            "sms": self.sms,
+            "mms_converted": self.mms_converted,
+            "mms_empty": self.mms_empty,
+            "mms_duplicates": self.mms_duplicates,
+            "copies": self.copies,
+            "written": self.written,
+        }
+
+    def add(self, counts):
+        # the counts of a worker
+        for name, count in counts.items():
+            setattr(self, name, getattr(self, name) + count)
+
+    def summary(self):
+        seconds = time.perf_counter() - self.start
+
+        return {
+            "seconds": seconds,
+            "messages_per_s": self.messages / seconds if seconds else 0,
+            "total_bytes": self.total_bytes,
+            **self.counts(),
+            "peak_rss_bytes": peak_rss(),
+        }
+
+    def __str__(self):
+        summary = self.summary()
+        read = f"{self.bytes_read / 1e6:.0f}/{self.total_bytes / 1e6:.0f} MB"
+
+        if self.total_bytes:
+            read += f" ({100 * self.bytes_read / self.total_bytes:.0f}%)"
+
+        copies = f", {self.copies} copies" if self.copies else ""
+        rss = f", peak {summary['peak_rss_bytes'] / 1e6:.0f} MB" if summary["peak_rss_bytes"] else ""
+
+        return (f"{self.messages} messages, {summary['messages_per_s']:.0f}/s, {read}, "
+            f"{self.mms_converted} mms converted, {self.mms_duplicates} duplicates, {self.mms_empty} without text"
+            f"{copies}{rss}")
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.summary(), file, indent=2)
+
+def peak_rss():
+    # in bytes, of this process or its biggest finished worker. None where unknown
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    # kB, other than on macos
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def iter_messages(path, start=None, end=None, progress=None):
+    # the sms and mms elements of a backup, one at a time, so that the whole backup
+    # is never in memory. backups with images can be several GB.
+    # with start and end, only the messages between those offsets, as found by find_shards
+    progress = progress or Progress()
+
+    # like ET.iterparse, but reading more at a time, since expat scans a long
+    # attribute again for every chunk it's split over
+    parser = ET.XMLPullParser(events=("start", "end"))
+    root = None
+
+    with open(path, "rb") as file:
+        if start is not None:
+            file.seek(start)
+            # the messages of a shard need a root of their own
+            parser.feed(b"<smses>")
+
+        while True:
+            chunk = file.read(READ_SIZE if end is None else min(READ_SIZE, end - file.tell()))
+
+            progress.bytes_read += len(chunk)
+
+            if chunk:
+                parser.feed(chunk)
+            else:
+                if start is not None:
+                    parser.feed(b"</smses>")
+
+                parser.close()
+
+            for event, el in parser.read_events():
+                if root is None:
+                    root = el
+
+                if event == "start":
+                    continue
+
+                # the base64 of images and such isn't needed
+                if el.tag == "part":
+                    el.attrib.pop("data", None)
+
+                elif el.tag in ["sms", "mms"]:
+                    yield el
+
+                    # forget the message; the caller keeps it if needed
+                    root.clear()
+
+            if not chunk:
+                return
+
+def find_message(file, offset):
+    # the offset of the first message starting at or after offset, or None.
+    # a < in a backup is always a tag, since it's escaped in attributes
+    file.seek(offset)
+    tail = b""
+
+    while True:
+        chunk = file.read(SHARD_SCAN_SIZE)
+
+        if not chunk:
+            return None
+
+        match = message_start.search(tail + chunk)
+
+        if match:
+            return offset - len(tail) + match.start()
+
+        offset += len(chunk)
+        # enough to find a tag split over two chunks
+        tail = chunk[-5:]
+
+def find_shards(path, shard_size):
+    # (start, end) offsets splitting the messages of a backup into shards of about
+    # shard_size bytes, each starting and ending at a message
+    with open(path, "rb") as file:
+        size = file.seek(0, os.SEEK_END)
+
+        file.seek(max(0, size - SHARD_SCAN_SIZE))
+        tail = file.read()
+        end = size - len(tail) + tail.rfind(b"</smses>")
+
+        starts = []
+
+        for offset in range(0, size, shard_size):
+            start = find_message(file, offset)
+
+            if start is not None and start < end and (not starts or start > starts[-1]):
+                starts.append(start)
+
+    return list(zip(starts, starts[1:] + [end]))
+
+# a backup has few addresses, over and over
+@functools.lru_cache(maxsize=1 << 12)
+def normalize_address(address):
+    # the same number can be written as +46701234567, 0701234567 or 070-123 45 67.
+    # group messages have their addresses separated by ~
+    addresses = []
+
+    for address in address.split("~"):
+        digits = "".join(c for c in address if c.isdigit())
+
+        # short codes and names are kept as they are
+        if len(digits) < DEDUP_ADDRESS_DIGITS:
+            addresses.append(address.strip().lower())
+        else:
+            addresses.append(digits[-DEDUP_ADDRESS_DIGITS:])
+
+    return "~".join(sorted(addresses))
+
+def normalize_body(body):
+    # line endings and spacing differ between the sms and mms copies of a message
+    return " ".join(body.split())
+
+class Seen:
+    # messages seen so far, to tell whether another one is a duplicate.
+    # messages are the same if they have the same address and body, and dates
+    # at most window ms apart. dates are kept in buckets window ms wide, so only
+    # the bucket of a date and the ones next to it need to be looked in.
+    def __init__(self, window=0):
+        self.window = window
+        self.dates = {}
+
+    def bucket(self, date):
+        return date // self.window if self.window else date
+
+    def add(self, address, body, date):
+        key = (normalize_address(address), normalize_body(body), self.bucket(date))
+        self.dates.setdefault(key, []).append(date)
+
+    def remove(self, address, body, date):
+        key = (normalize_address(address), normalize_body(body), self.bucket(date))
+        dates = self.dates[key]
+        dates.remove(date)
+
+        if not dates:
+            del self.dates[key]
+
+    def __contains__(self, message):
+        address, body, date = message
+        address = normalize_address(address)
+        body = normalize_body(body)
+        bucket = self.bucket(date)
+
+        for b in [bucket - 1, bucket, bucket + 1] if self.window else [bucket]:
+            for seen_date in self.dates.get((address, body, b), []):
+                if abs(date - seen_date) <= self.window:
+                    return True
+
+        return False
+
+def mms_body(mms):
+    # the text of the last text/plain part of an mms, or None if it has none, as the
+    # last part was taken before parts were told apart by type. the other parts are
+    # the smil layout, images and such
+    parts = mms.find("parts")
+    body = None
+
+    if parts is None:
+        return None
+
+    for part in parts:
+        if part.get("ct") == "text/plain":
+            body = part.get("text", "")
+
+    return body
+
+@functools.lru_cache(maxsize=1 << 12)
+def split_address(address):
+    # the normalized addresses of the contacts of a message
+    return frozenset(normalize_address(address) for address in address.split("~"))
+
+def mms_out(mms, address):
+    # whether an mms was sent rather than received. the sender is the address of type
+    # from, which for a received message is the contact, or one of them in a group.
+    # backups without addresses still say whether a message is in the sent box
+    addrs = mms.find("addrs")
+
+    if addrs is not None:
+        for addr in addrs:
+            if addr.get("type") == ADDR_TYPE_FROM:
+                sender_address = addr.get("address", "")
+                return sender_address != address and normalize_address(sender_address) not in split_address(address)
+
+    return mms.get("msg_box") == MSG_BOX_SENT
+
+def import_message(message):
+    # an sms element of a backup, ready to be exported, or an mms converted to Sms,
+    # along with the address, body and date to find duplicates by. None for an mms
+    # with nothing to convert
+    if message.tag == "sms":
+        key = (message.attrib["address"], message.attrib["body"], int(message.attrib["date"]))
+        return key, message
+
+    mms = message
+    body = mms_body(mms)
+
+    if body is None:
+        return None
+
+    date = mms.attrib["date"]
+    address = mms.attrib["address"]
+    key = (address, body, int(date))
+
+    sub_id = mms.get("sub_id", "null")
+    readable_date = mms.get("readable_date", "null")
+    contact_name = mms.get("contact_name", "null")
+
+    out = mms_out(mms, address)
+
+    sms = Sms(address, date, out, body, sub_id, readable_date, contact_name)
+
+    #print(sms)
+
+    return key, sms
+
+def import_mms(messages, window=None, progress=None):
+    # messages are the elements of a backup, or the root element of one.
+    # sms elements are passed on as they come, and the mms after them, converted to
+    # Sms. mms that are duplicates of an sms are left out, wherever in the backup the sms is
+    sms_seen = Seen(DEDUP_WINDOW if window is None else window)
     smses = []
+    progress = progress or Progress()
+
+    for message in messages:
+        imported = import_message(message)
+        progress.imported(message, imported)
 
-    for mms in root:
-        if mms.tag == "sms":
-            sms_text_existing.append(mms.attrib["body"])
-            mms.attrib["body"] = mms.attrib["body"].replace("\n", "&#10;")
-            sms_existing.append(mms)
+        if imported is None:
             continue
 
-        parts = mms[0]
+        key, sms = imported
 
-        if len(parts) == 0:
-            continue
+        if message.tag == "sms":
+            sms_seen.add(*key)
+            yield sms
+        else:
+            smses.append((key, sms))
 
-        part = parts[-1]
-        body = part.attrib["text"]
+    for key, sms in smses:
+        if key in sms_seen:
+            progress.mms_duplicates += 1
+        else:
+            yield sms
 
-        if body in sms_text_existing:
-            continue
+def escape_attribute(value):
+    # most values have nothing to escape, and searching is quicker than replacing
+    return escape(value, ATTRIBUTE_ENTITIES) if attribute_special.search(value) else value
+
+def root_tag(count):
+    # the count is only known once everything is written, so the tag is padded
+    # to the same width whatever the count, to be written over at the end
+    return f'<smses count="{count}"'.ljust(len('<smses count=""') + COUNT_DIGITS) + ">\n"
+
+def sms_xml(sms):
+    # the line of an sms in sms.xml
+    attrib = sms.attrib
+
+    # newlines in bodies have always been written as the text &#10;
+    if "\n" in attrib["body"]:
+        attrib = {**attrib, "body": attrib["body"].replace("\n", "&#10;")}
+
+    attributes = " ".join(f'{name}="{escape_attribute(value)}"' for name, value in attrib.items())
+    return f"  <{sms.tag} {attributes}/>\n".encode()
+
+def export_sms(smses, path="sms.xml"):
+    # written as it goes, laid out like minidom's toprettyxml(indent="  "), so that
+    # the messages are never all in memory as a tree or a string.
+    # smses are elements or Sms, anything with a tag and attrib
+    count = 0
+
+    with open(path, "wb") as file:
+        file.write(XML_HEADER)
+        file.write(root_tag(0).encode())
+
+        for sms in smses:
+            file.write(sms_xml(sms))
+            count += 1
+
+        file.write(b"</smses>\n")
+
+        file.seek(len(XML_HEADER))
+        file.write(root_tag(count).encode())
+
+    return count
+
+def export_jsonl(smses, path="sms.jsonl"):
+    # a json object of the attributes of each message, one per line
+    count = 0
+
+    with open(path, "w", encoding="utf-8") as file:
+        for sms in smses:
+            file.write(json.dumps(sms.attrib, ensure_ascii=False) + "\n")
+            count += 1
+
+    return count
+
+def sqlite_row(attrib):
+    return [int(attrib["date"]) if name == "date" else attrib.get(name) for name in SQLITE_COLUMNS]
+
+def export_sqlite(smses, path="sms.sqlite"):
+    # a table of messages to query without parsing xml again, with a column for each
+    # attribute in SQLITE_COLUMNS. the indexes are made after inserting, which is
+    # quicker than keeping them up to date
+    if os.path.exists(path):
+        os.remove(path)
+
+    connection = sqlite3.connect(path)
+    columns = ", ".join(f"{name} INTEGER" if name == "date" else f"{name} TEXT" for name in SQLITE_COLUMNS)
+    connection.execute(f"CREATE TABLE sms ({columns})")
+    insert = f"INSERT INTO sms VALUES ({', '.join('?' * len(SQLITE_COLUMNS))})"
+
+    rows = (sqlite_row(sms.attrib) for sms in smses)
+    count = 0
+
+    with connection:
+        while batch := list(itertools.islice(rows, SQLITE_BATCH_SIZE)):
+            connection.executemany(insert, batch)
+            count += len(batch)
+
+        connection.execute("CREATE INDEX sms_address ON sms (address)")
+        connection.execute("CREATE INDEX sms_date ON sms (date)")
+
+    connection.close()
+
+    return count
+
+def write_frame(file, record):
+    data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+    file.write(len(data).to_bytes(8, "little") + data)
+
+def read_frames(file):
+    # the records of a file of frames, with the offset after each. a frame cut
+    # short by a crash while writing it, and anything after, is left out
+    while True:
+        size = file.read(8)
+        data = file.read(int.from_bytes(size, "little")) if len(size) == 8 else b""
+
+        if not data or len(data) < int.from_bytes(size, "little"):
+            return
+
+        yield pickle.loads(data), file.tell()
+
+def checkpoint_input(path):
+    # a checkpoint is only good for the same backup
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+def convert_checkpointed(path, output_path="sms.xml", resume=False, window=None, checkpoint_size=None, progress=None):
+    # like export_sms(import_mms(iter_messages(path)), output_path), but in shards
+    # of checkpoint_size bytes, after each of which a checkpoint is appended: where the
+    # shard ends in the backup and the output, the count of messages written, the
+    # sms and converted mms of the shard, for the dedup, and the counts of progress so far.
+    # with resume, a run that was stopped goes on from its last checkpoint, and the output
+    # and the counts are the same as if it hadn't.
+    # the output is written to .partial until done
+    partial_path = output_path + ".partial"
+    checkpoint_path = output_path + ".checkpoint"
+    checkpoint_size = checkpoint_size or CHECKPOINT_SIZE
+    progress = progress or Progress()
+
+    sms_seen = Seen(DEDUP_WINDOW if window is None else window)
+    smses = []
+    offset = 0
+    output_offset = None
+    count = 0
+    counts = None
+
+    if resume and os.path.exists(checkpoint_path) and os.path.exists(partial_path):
+        with open(checkpoint_path, "rb") as file:
+            frames = read_frames(file)
+            first = next(frames, None)
+
+            if first is not None and first[0] != (checkpoint_input(path), checkpoint_size):
+                raise ValueError(f"{checkpoint_path} is for another backup, or was made with another checkpoint size")
+
+            checkpoint_end = first[1] if first is not None else 0
+
+            for frame, checkpoint_end in frames:
+                if len(frame) != 6:
+                    raise ValueError(f"{checkpoint_path} was made by an older version; remove it to start over")
+
+                offset, output_offset, count, sms_keys, converted, counts = frame
+
+                for key in sms_keys:
+                    sms_seen.add(*key)
+
+                smses += converted
 
-        body = body.replace("\n", "&#10;")
+    # the shards done before, as they were counted then
+    if counts is not None:
+        progress.add(counts)
 
-        date = mms.attrib["date"]
-        address = mms.attrib["address"]
-        sub_id = mms.attrib["sub_id"]
-        readable_date = mms.attrib["readable_date"]
-        contact_name = mms.attrib["contact_name"]
+    if output_offset is None:
+        output = open(partial_path, "wb")
+        output.write(XML_HEADER)
+        output.write(root_tag(0).encode())
 
-        # out if address specified in head (contact) is not equal to sender.
-        sender_address = mms[1][0].attrib["address"]
-        out = address != sender_address
+        checkpoint = open(checkpoint_path, "wb")
+        write_frame(checkpoint, (checkpoint_input(path), checkpoint_size))
+    else:
+        output = open(partial_path, "r+b")
+        output.truncate(output_offset)
+        output.seek(output_offset)
 
-        sms = Sms(address, date, out, body, sub_id, readable_date, contact_name)
-        smses.append(sms.el)
+        checkpoint = open(checkpoint_path, "r+b")
+        checkpoint.truncate(checkpoint_end)
+        checkpoint.seek(checkpoint_end)
 
-        #print(sms)
+    with output, checkpoint:
+        for start, end in find_shards(path, checkpoint_size):
+            if start < offset:
+                continue
 
+            sms_keys = []
+            converted = []
 
-    return sms_existing + smses
+            for message in iter_messages(path, start, end, progress):
+                imported = import_message(message)
+                progress.imported(message, imported)
 
-def export_sms(smses):
-    root = ET.Element("smses")
+                if imported is None:
+                    continue
 
-    for sms in smses:
-        ET.SubElement(root, sms.tag, sms.attrib)
+                key, sms = imported
 
-    #tree = ET.ElementTree(root)
-    #tree.write("sms.xml", "UTF-8")
+                if message.tag == "sms":
+                    sms_seen.add(*key)
+                    sms_keys.append(key)
+                    output.write(sms_xml(sms))
+                    count += 1
+                else:
+                    converted.append((key, sms))
 
-    xmlstr = minidom.parseString(ET.tostring(root)).toprettyxml(indent="  ")
-    with open("sms.xml", "w", encoding="utf-8") as file:
-        file.write(xmlstr)
+            smses += converted
+
+            # the output has to be on disk before the checkpoint that points into it
+            output.flush()
+            os.fsync(output.fileno())
+            write_frame(checkpoint, (end, output.tell(), count, sms_keys, converted, progress.counts()))
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+
+        for key, sms in smses:
+            if key in sms_seen:
+                progress.mms_duplicates += 1
+            else:
+                output.write(sms_xml(sms))
+                count += 1
+
+        output.write(b"</smses>\n")
+        output.seek(len(XML_HEADER))
+        output.write(root_tag(count).encode())
+
+    os.replace(partial_path, output_path)
+    os.remove(checkpoint_path)
+
+    return count
+
+def convert_shard(shard, progress=None):
+    # imports a backup, or a shard of one, into a run of messages sorted by date,
+    # saved to run_path so that the runs of all shards can be merged without being
+    # in memory. messages are (date, is mms, key, sms), as from import_message.
+    # returns the counts of progress, or of the shard if not given, as in a worker
+    path, start, end, run_path = shard
+    run = []
+    progress = progress or Progress()
+
+    for message in iter_messages(path, start, end, progress):
+        imported = import_message(message)
+        progress.imported(message, imported)
+
+        if imported is not None:
+            key, sms = imported
+            run.append((key[2], message.tag == "mms", key, sms))
+
+    run.sort(key=lambda message: message[0])
+
+    with open(run_path, "wb") as file:
+        for i in range(0, len(run), RUN_CHUNK_SIZE):
+            pickle.dump(run[i:i + RUN_CHUNK_SIZE], file)
+
+    return progress.counts()
+
+def read_run(run_path):
+    with open(run_path, "rb") as file:
+        while True:
+            try:
+                yield from pickle.load(file)
+            except EOFError:
+                return
+
+def dedup_sorted(messages, window=None, progress=None):
+    # messages sorted by date, as from convert_shard, without the mms that duplicate
+    # an sms or messages that are exactly the same as one before, from another backup
+    # of the same phone. since an mms can only be a duplicate of an sms at most window
+    # ms away, only the messages that close to the one being passed on are kept
+    window = DEDUP_WINDOW if window is None else window
+    progress = progress or Progress()
+    pending = collections.deque()
+    sms_seen = Seen(window)
+    # the sms in sms_seen, to forget in the order they came
+    sms_keys = collections.deque()
+    # the messages passed on with the date of the last one
+    same_date = set()
+    last_date = None
+
+    # None at the end, to pass on what's left
+    for message in itertools.chain(messages, [None]):
+        if message is not None:
+            pending.append(message)
+
+            if not message[1]:
+                sms_seen.add(*message[2])
+                sms_keys.append(message[2])
+
+        while pending and (message is None or pending[0][0] < message[0] - window):
+            date, is_mms, key, sms = pending.popleft()
+
+            while sms_keys and sms_keys[0][2] < date - window:
+                sms_seen.remove(*sms_keys.popleft())
+
+            if is_mms and key in sms_seen:
+                progress.mms_duplicates += 1
+                continue
+
+            if date != last_date:
+                same_date.clear()
+                last_date = date
+
+            same = (sms.tag, tuple(sms.attrib.items()))
+
+            if same in same_date:
+                progress.copies += 1
+                continue
+
+            same_date.add(same)
+            yield sms
+
+def convert_batch(paths, output_path="sms.xml", workers=None, shard_size=None, window=None, export=None, progress=None):
+    # converts several backups, each split into shards of shard_size bytes if given,
+    # in a pool of workers, into a single sms.xml sorted by date, or whatever export writes.
+    # workers defaults to the number of cores; 1 converts in this process.
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    progress = progress or Progress()
+
+    with tempfile.TemporaryDirectory() as run_folder:
+        shards = []
+
+        for path in paths:
+            ranges = find_shards(path, shard_size) if shard_size else [(None, None)]
+
+            for start, end in ranges:
+                shards.append((path, start, end, os.path.join(run_folder, f"{len(shards)}.pickle")))
+
+        if workers > 1:
+            with multiprocessing.Pool(workers) as pool:
+                for counts in pool.imap_unordered(convert_shard, shards):
+                    progress.add(counts)
+                    progress.check()
+        else:
+            for shard in shards:
+                convert_shard(shard, progress)
+
+        # merge keeps the order of the shards for the same date, so messages stay
+        # in the order of the backup
+        runs = [read_run(shard[3]) for shard in shards]
+        messages = heapq.merge(*runs, key=lambda message: message[0])
+
+        return (export or export_sms)(dedup_sorted(messages, window, progress), output_path)
+
+exporters = {
+    "xml": export_sms,
+    "jsonl": export_jsonl,
+    "sqlite": export_sqlite,
+}
+
+XML_HEADER = b'<?xml version="1.0" ?>\n'
+
+# seconds between printing progress
+PROGRESS_INTERVAL = 1.0
+# messages between looking at the clock, to see if progress is due
+PROGRESS_CHECK = 1000
+# bytes read from the backup at a time
+READ_SIZE = 1 << 20
+# room left for the count of messages in sms.xml
+COUNT_DIGITS = 10
+# escaped in attributes, besides & < and >. whitespace other than spaces would be
+# read back as spaces if written as is
+ATTRIBUTE_ENTITIES = {'"': "&quot;", "\n": "&#10;", "\r": "&#13;", "\t": "&#9;"}
+attribute_special = re.compile("[&<>" + "".join(ATTRIBUTE_ENTITIES) + "]")
+# bytes looked through at a time for where a message starts, when sharding
+SHARD_SCAN_SIZE = 1 << 16
+message_start = re.compile(rb"<(?:sms|mms)[\s/>]")
+# messages pickled together in a run
+RUN_CHUNK_SIZE = 1000
+# an mms is a duplicate of an sms with the same address and body sent at most this
+# many ms before or after it. 0 to only match the exact same date
+DEDUP_WINDOW = 60 * 1000
+# numbers are compared by their last digits, so that country codes and trunk prefixes
+# don't matter. android compares the last 7 too
+DEDUP_ADDRESS_DIGITS = 7
+
+# the attributes of an sms that export_sqlite has columns for. others are left out
+SQLITE_COLUMNS = ["protocol", "address", "date", "type", "subject", "body", "toa", "sc_toa", "service_center",
+    "read", "status", "locked", "date_sent", "sub_id", "readable_date", "contact_name"]
+# rows inserted at a time
+SQLITE_BATCH_SIZE = 10000
+# the type of the address an mms is from, in the pdu spec
+ADDR_TYPE_FROM = "137"
+# the msg_box of sent mms
+MSG_BOX_SENT = "2"
+# bytes of the backup converted between checkpoints
+CHECKPOINT_SIZE = 1 << 26
+# processes converting backups in batch mode. None for the number of cores
+WORKERS = None
+# shard backups bigger than this, in batch mode. None to convert each backup whole
+SHARD_SIZE = None
 
 def main():
-    tree = ET.parse("mms.xml")
-    root = tree.getroot()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="*", default=["mms.xml"], help="backups to convert")
+    parser.add_argument("--format", choices=list(exporters), default="xml")
+    parser.add_argument("--output", help="defaults to sms.FORMAT")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--shard-size", type=int, default=SHARD_SIZE, metavar="BYTES",
+        help="split backups into shards of about this size, converted in parallel")
+    parser.add_argument("--resume", action="store_true", help="go on from where a conversion to xml was stopped")
+    parser.add_argument("--summary", metavar="PATH", help="also save the counts and timings of the run as json")
+    args = parser.parse_args()
+
+    # one backup is converted in this process, with sms kept in the order of the backup.
+    # more, or shards, are converted in parallel and merged by date
+    export = exporters[args.format]
+    output_path = args.output or f"sms.{args.format}"
+
+    # xml from one backup is written as it goes, with checkpoints to resume from
+    if args.resume and (len(args.paths) != 1 or args.shard_size or args.format != "xml"):
+        parser.error("--resume only works converting one backup to xml, without --shard-size")
+
+    progress = Progress(sum(os.path.getsize(path) for path in args.paths), PROGRESS_INTERVAL)
+
+    if len(args.paths) == 1 and not args.shard_size and args.format == "xml":
+        progress.written = convert_checkpointed(args.paths[0], output_path, args.resume, progress=progress)
+    elif len(args.paths) == 1 and not args.shard_size:
+        smses = import_mms(iter_messages(args.paths[0], progress=progress), progress=progress)
+        progress.written = export(smses, output_path)
+    else:
+        progress.written = convert_batch(args.paths, output_path, args.workers, args.shard_size, export=export,
+            progress=progress)
+
+    print(f"{progress}, {progress.written} written")
 
-    smses = import_mms(root)
-    export_sms(smses)
+    if args.summary:
+        progress.save(args.summary)
 
     print("done!")
 
@@ -0,0 +1,186 @@
+import argparse
+import gc
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+import mms_to_sms
+
+# benchmarks for mms_to_sms, on synthetic backups.
+# messages are generated from a seed, with a known number of mms that duplicate an sms,
+# so that the count of messages left after importing can be checked as well as timed.
+
+TEXTS = ["ok", "Hej!", "see you\nat 5", "tack ❤", "\"quoted\" & <tag>", "on my way", "emoji \U0001F600", "  spaced  "]
+
+CONTACTS = [("+46701234567", "Anna"), ("+46709876543", "Bo"), ("+46705550123", "Cecilia"), ("+4670111222", "Dan"),
+    ("72400", "Bank")]
+
+ME = "+46700000000"
+
+def local_address(address):
+    # how the phone writes a number it got without the country code
+    return "0" + address[3:] if address.startswith("+46") else address
+
+def sms_element(address, date, body, name):
+    return ET.Element("sms", {"protocol": "0", "address": address, "date": str(date), "type": "1",
+        "subject": "null", "body": body, "toa": "null", "sc_toa": "null", "service_center": "null",
+        "read": "1", "status": "-1", "locked": "0", "date_sent": "0", "sub_id": "1",
+        "readable_date": time.strftime("%b %d, %Y %H:%M:%S", time.gmtime(date // 1000)), "contact_name": name})
+
+def mms_element(address, date, body, name, out):
+    mms = ET.Element("mms", {"date": str(date), "address": address, "msg_box": "2" if out else "1", "sub_id": "1",
+        "readable_date": time.strftime("%b %d, %Y %H:%M:%S", time.gmtime(date // 1000)), "contact_name": name})
+
+    parts = ET.SubElement(mms, "parts")
+    ET.SubElement(parts, "part", {"seq": "-1", "ct": "application/smil", "text": "<smil><body></body></smil>"})
+    ET.SubElement(parts, "part", {"seq": "0", "ct": "text/plain", "text": body})
+
+    addrs = ET.SubElement(mms, "addrs")
+    ET.SubElement(addrs, "addr", {"address": ME if out else address, "type": "137"})
+    ET.SubElement(addrs, "addr", {"address": address if out else ME, "type": "151"})
+
+    return mms
+
+def generate_messages(n: int, seed: int = 0, dup_ratio: float = 0.2, counts: dict = None):
+    # half sms, half mms. of the mms, dup_ratio are copies of an sms: the same body with
+    # other line endings, the number written another way and a date a few seconds off.
+    # as many again have the body of an sms from the same contact a day or more earlier, and
+    # are kept. messages are more than DEDUP_WINDOW apart, so nothing else is a duplicate
+    rng = random.Random(seed)
+    sms_sent = []
+    date = 1600000000000
+    counts = {} if counts is None else counts
+    counts["duplicates"] = 0
+
+    for i in range(n):
+        date += rng.randrange(61000, 1000000)
+        address, name = rng.choice(CONTACTS)
+
+        if rng.random() < 0.5:
+            body = rng.choice(TEXTS) + (f" {rng.randrange(100)}" if rng.random() < 0.5 else "")
+            sms_sent.append((address, date, body, name))
+            yield sms_element(address, date, body, name)
+            continue
+
+        r = rng.random()
+
+        if sms_sent and r < dup_ratio:
+            address, sms_date, body, name = sms_sent[-1]
+            counts["duplicates"] += 1
+            yield mms_element(local_address(address), sms_date + rng.randrange(-5000, 5000), body.replace("\n", "\r\n"), name, False)
+
+        elif sms_sent and r < 2 * dup_ratio and date - sms_sent[0][1] > 86400 * 1000:
+            address, sms_date, body, name = sms_sent[rng.randrange(len(sms_sent))]
+            while date - sms_date <= 86400 * 1000:
+                address, sms_date, body, name = sms_sent[rng.randrange(len(sms_sent))]
+            yield mms_element(address, date, body, name, rng.random() < 0.5)
+
+        else:
+            yield mms_element(address, date, f"{rng.choice(TEXTS)} mms {i}", name, rng.random() < 0.5)
+
+def bench_import(n: int, repeat: int, window: int = None) -> dict:
+    best = None
+
+    for _ in range(repeat):
+        counts = {}
+        messages = generate_messages(n, counts=counts)
+
+        # generating isn't part of the timing, but is interleaved with importing,
+        # so it's timed on its own and taken off
+        gc.collect()
+        gc.disable()
+        start = time.perf_counter()
+        for _ in generate_messages(n):
+            pass
+        generate_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        kept = sum(1 for _ in mms_to_sms.import_mms(messages, window))
+        seconds = time.perf_counter() - start - generate_s
+        gc.enable()
+
+        if best is None or seconds < best:
+            best = seconds
+
+    return {"messages": n, "seconds": best, "messages_per_s": n / best, "kept": kept, "expected": n - counts["duplicates"]}
+
+def measure_import(n: int) -> dict:
+    # the converted mms are held until the end, so the peak is mostly them
+    tracemalloc.start()
+    for _ in mms_to_sms.import_mms(generate_messages(n)):
+        pass
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"messages": n, "peak_bytes": peak}
+
+def bench_export(smses: list, repeat: int, format: str = "xml") -> dict:
+    best = None
+
+    with tempfile.TemporaryDirectory() as folder_path:
+        path = os.path.join(folder_path, f"sms.{format}")
+
+        for _ in range(repeat):
+            gc.collect()
+            gc.disable()
+            start = time.perf_counter()
+            mms_to_sms.exporters[format](smses, path)
+            seconds = time.perf_counter() - start
+            gc.enable()
+
+            if best is None or seconds < best:
+                best = seconds
+
+        size = os.path.getsize(path)
+
+    return {"messages": len(smses), "seconds": best, "messages_per_s": len(smses) / best, "bytes": size}
+
+SCALES = {
+    "10k": 10_000,
+    "100k": 100_000,
+    "1m": 1_000_000,
+}
+
+REPEAT = 3
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark mms_to_sms on synthetic backups")
+    parser.add_argument("--scales", nargs="+", choices=list(SCALES), default=list(SCALES))
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="best of this many runs")
+    parser.add_argument("--window", type=int, help="dedup window in ms, instead of DEDUP_WINDOW")
+    parser.add_argument("--formats", nargs="+", choices=list(mms_to_sms.exporters), default=list(mms_to_sms.exporters))
+    parser.add_argument("--memory", action="store_true", help="also measure the memory import_mms peaks at, with tracemalloc")
+    args = parser.parse_args()
+
+    failed = False
+
+    for name in args.scales:
+        result = bench_import(SCALES[name], args.repeat, args.window)
+        print(f"{name:>5} {'import_mms':<14}{result['seconds']:6.3f} s {result['messages_per_s']:10.0f} messages/s"
+            f"   kept {result['kept']}, expected {result['expected']}")
+
+        if result["kept"] != result["expected"]:
+            failed = True
+
+        if args.memory:
+            result = measure_import(SCALES[name])
+            print(f"{name:>5} {'import_mms':<14}{result['peak_bytes'] / 1e6:6.1f} MB peak traced")
+
+        smses = list(mms_to_sms.import_mms(generate_messages(SCALES[name])))
+
+        for format in args.formats:
+            result = bench_export(smses, args.repeat, format)
+            print(f"{name:>5} {'export ' + format:<14}{result['seconds']:6.3f} s {result['messages_per_s']:10.0f} messages/s"
+                f"   {result['bytes'] / 1e6:.1f} MB")
+
+        del smses
+
+    if failed:
+        print("kept messages differ from expected")
+        exit(1)
+
+if __name__ == "__main__":
+    main()